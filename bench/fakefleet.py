@@ -0,0 +1,244 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    fakefleet.py -> simulated fleet of Cisco IOS ssh devices
+
+    A single paramiko ssh server listens on one port of every loopback
+    address.  Linux answers all of 127.0.0.0/8 on the loopback interface, so
+    each fake device gets its own address (see device_ip()) and is told apart
+    by the address the client connected to.  Every device runs a tiny IOS
+    style shell that understands terminal length/width, show running-config
+    (with | include, as used by the change probe) and exit.
+
+    Parameters
+        size        - approximate bytes of running-config per device
+        latency     - seconds a device waits before answering show running-config
+        fail_rate   - fraction of logins that are refused
+        change_rate - fraction of polls that find a new revision
+
+    Copyright 2017 Ron Wellman
+'''
+
+import logging
+import random
+import socket
+import threading
+import time
+import paramiko
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+#refused logins are expected, keep paramiko quiet about them
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+def device_ip(index):
+    '''
+        returns the loopback address of the device with the given index
+    '''
+    #127.0.0.1 is left alone, everything above it is a device
+    n = index + 2
+    return '127.{}.{}.{}'.format((n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+def device_index(ip):
+    '''
+        reverses device_ip()
+    '''
+    octets = [int(octet) for octet in ip.split('.')]
+    return (octets[1] << 16 | octets[2] << 8 | octets[3]) - 2
+
+def running_config(index, revision, size, changed):
+    '''
+        returns an IOS style running-config of about size bytes, last changed at
+        the changed unix time
+    '''
+    hostname = 'bench{}'.format(index)
+    lines = ['Building configuration...',
+             '',
+             'Current configuration : {} bytes'.format(size),
+             '!',
+             '! Last configuration change at {} UTC'.format(time.strftime('%H:%M:%S %a %b %d %Y', time.gmtime(changed))),
+             '!',
+             'version 15.2',
+             'hostname {}'.format(hostname),
+             '!',
+             'banner motd ^C revision {} ^C'.format(revision)]
+    length = sum(len(line) + 1 for line in lines)
+    interface = 0
+    while length < size:
+        block = ['interface GigabitEthernet0/{}'.format(interface),
+                 ' description bench link {} of {}'.format(interface, hostname),
+                 ' ip address 10.{}.{}.1 255.255.255.252'.format(index % 250, interface % 250),
+                 ' no shutdown',
+                 '!']
+        lines.extend(block)
+        length += sum(len(line) + 1 for line in block)
+        interface += 1
+    lines.append('end')
+    return '\r\n'.join(lines)
+
+class FakeDevice(paramiko.ServerInterface):
+    '''
+        ssh server side of one connection
+    '''
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.index = index
+        self.shell = threading.Event()
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if random.random() < self.fleet.fail_rate:
+            return paramiko.AUTH_FAILED
+        if username == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell.set()
+        return True
+
+class FakeFleet(object):
+    '''
+        ssh listener serving count fake devices on port
+    '''
+
+    def __init__(self, count, port=2222, size=20000, latency=0.0, fail_rate=0.0, change_rate=0.0):
+        self.count = count
+        self.port = port
+        self.size = size
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.change_rate = change_rate
+        self.revisions = [0] * count
+        self.changed = [time.time()] * count
+        self.lock = threading.Lock()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sessions = 0
+        self.sock = None
+
+    def start(self):
+        '''
+            starts accepting connections on a background thread
+        '''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', self.port))
+        self.sock.listen(1024)
+        t = threading.Thread(target=self._accept, name='fakefleet-accept')
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        if self.sock is not None:
+            sock, self.sock = self.sock, None
+            #close() alone leaves the accept thread blocked holding the port
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def inventory(self):
+        '''
+            returns an nbmon inventory dictionary for the fleet
+        '''
+        return {'devices': [{'device_type': 'cisco_ios', 'ip': device_ip(i), 'port': self.port,
+                             'description': 'bench{}'.format(i), 'username': USERNAME,
+                             'password': PASSWORD, 'actively_poll': True} for i in range(self.count)]}
+
+    def _accept(self):
+        while self.sock is not None:
+            try:
+                client, address = self.sock.accept()
+            except (socket.error, AttributeError):
+                return
+            #the fleet has a fixed login, only answer on the loopback addresses
+            if not client.getsockname()[0].startswith('127.'):
+                client.close()
+                continue
+            t = threading.Thread(target=self._serve, args=(client,))
+            t.daemon = True
+            t.start()
+
+    def _roll(self, index):
+        '''
+            gives the device a new revision with probability change_rate, done
+            once per poll so a probe and the fetch after it agree
+        '''
+        with self.lock:
+            if random.random() < self.change_rate:
+                self.revisions[index] += 1
+                self.changed[index] = time.time()
+
+    def _config(self, index):
+        with self.lock:
+            revision = self.revisions[index]
+            changed = self.changed[index]
+        return running_config(index, revision, self.size, changed)
+
+    def _serve(self, client):
+        index = device_index(client.getsockname()[0])
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        device = FakeDevice(self, index)
+        try:
+            transport.start_server(server=device)
+            channel = transport.accept(30)
+            if channel is None or not device.shell.wait(30):
+                return
+            with self.lock:
+                self.sessions += 1
+            self._shell(channel, index)
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+        finally:
+            transport.close()
+
+    def _shell(self, channel, index):
+        prompt = 'bench{}#'.format(index)
+        channel.sendall('\r\n' + prompt)
+        buf = ''
+        #a poll is a change probe followed by at most one full fetch, or a full fetch alone
+        probed = False
+        while True:
+            data = channel.recv(1024)
+            if not data:
+                return
+            #echo what was typed like a real terminal
+            channel.sendall(data)
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                command = line.strip()
+                if command in ('exit', 'logout'):
+                    channel.close()
+                    return
+                if command.startswith('show run'):
+                    if self.latency:
+                        time.sleep(self.latency)
+                    probe = ' | include ' in command
+                    if probe or not probed:
+                        self._roll(index)
+                    probed = probe
+                    config = self._config(index)
+                    if probe:
+                        #change probes only want the matching lines
+                        pattern = command.split(' | include ', 1)[1]
+                        config = '\r\n'.join(line for line in config.split('\r\n') if pattern in line)
+                    channel.sendall('\r\n' + config)
+                elif command and not command.startswith('terminal'):
+                    channel.sendall("\r\n% Invalid input detected at '^' marker.")
+                channel.sendall('\r\n' + prompt)
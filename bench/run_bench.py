@@ -0,0 +1,153 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    run_bench.py -> throughput benchmark against a simulated device fleet
+
+    For every fleet size a fresh working directory is created, the fleet's
+    inventory is loaded with nbmon.py -f, and nbmon.py --daemon is run as a
+    child process for the given number of sweeps against bench/fakefleet.py.
+    The first sweep stores every config, later sweeps mostly find no change
+    (see --change-rate).  Before the sweeps get_config() is timed directly
+    against the first device.
+
+    Reported per sweep:
+        devices/sec - devices polled divided by the wall time of the sweep
+        p50/p99     - poll latency (connect + fetch + hash + persist) from poll_history
+        failed      - polls that ended in an error
+        db growth   - bytes the database file (plus its WAL) grew during the sweep
+        peak rss    - maximum resident set size of the nbmon process
+
+    Parameters
+        -n  - fleet sizes to run (repeatable, default 100, 1000 and 10000)
+        -w  - nbmon --workers
+        --sweeps, --size, --latency, --fail-rate, --change-rate, --port, --keep
+
+    Example
+        python bench/run_bench.py -n 100 -n 1000 -w 32 --latency 0.2 --change-rate 0.05
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import click
+from fakefleet import FakeFleet
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def db_size(workdir):
+    '''
+        bytes used by the database file and its write ahead log
+    '''
+    size = 0
+    for name in ('nbmon.db', 'nbmon.db-wal'):
+        path = os.path.join(workdir, name)
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
+
+def nbmon(workdir, *args):
+    '''
+        runs nbmon.py in workdir, returns (wall seconds, peak rss in KB)
+    '''
+    with open(os.path.join(workdir, 'nbmon.out'), 'a') as out:
+        started = time.time()
+        child = subprocess.Popen([sys.executable, '-W', 'ignore', os.path.join(REPO, 'nbmon.py')] + list(args),
+            cwd=workdir, stdout=out, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(child.pid, 0)
+        elapsed = time.time() - started
+    if status:
+        raise click.ClickException('nbmon {} failed, see {}'.format(' '.join(args), out.name))
+    #ru_maxrss is in KB on Linux
+    return elapsed, usage.ru_maxrss
+
+def sweep_stats(workdir, since):
+    '''
+        returns (polls, failed, sorted latencies) of the polls recorded since a timestamp
+    '''
+    conn = sqlite3.connect(os.path.join(workdir, 'nbmon.db'))
+    try:
+        rows = conn.execute('SELECT outcome, coalesce(connect_time, 0) + coalesce(fetch_time, 0) + '
+            'coalesce(hash_time, 0) + coalesce(persist_time, 0) FROM poll_history WHERE timestamp >= ?',
+            (since,)).fetchall()
+    finally:
+        conn.close()
+    return len(rows), sum(1 for outcome, total in rows if outcome == 'failed'), sorted(total for outcome, total in rows)
+
+def time_get_config(fleet, count=10):
+    '''
+        returns the sorted seconds of count direct get_config() calls against the first device
+    '''
+    sys.path.insert(0, REPO)
+    try:
+        from utils.util import get_config
+        import db.sqlite_query as db
+        #never added to a session, the database stays the one nbmon.py opens per run
+        device = db.Device(**fleet.inventory()['devices'][0])
+        times = []
+        with open(os.devnull, 'w') as log:
+            for i in range(count):
+                started = time.time()
+                get_config(device, log)
+                times.append(time.time() - started)
+        return sorted(times)
+    finally:
+        sys.path.remove(REPO)
+
+@click.command()
+@click.option('--devices', '-n', help='fleet sizes to benchmark', type=click.IntRange(1, 2 ** 24 - 3), multiple=True)
+@click.option('--workers', '-w', help='nbmon --workers', type=click.IntRange(1, None), default=8)
+@click.option('--sweeps', help='daemon passes per fleet size', type=click.IntRange(1, None), default=2)
+@click.option('--size', help='bytes of running-config per device', type=click.IntRange(100, None), default=20000)
+@click.option('--latency', help='seconds each device takes to answer show running-config', type=float, default=0.0)
+@click.option('--fail-rate', help='fraction of logins refused', type=float, default=0.0)
+@click.option('--change-rate', help='fraction of polls that find a changed config', type=float, default=0.0)
+@click.option('--port', help='ssh port of the fake fleet', type=click.IntRange(1, 65535), default=2222)
+@click.option('--keep', help='keep the working directories (database, inventory, nbmon output)', is_flag=True)
+def bench(devices, workers, sweeps, size, latency, fail_rate, change_rate, port, keep):
+    '''
+        benchmarks nbmon --daemon against simulated Cisco IOS devices
+    '''
+    for count in devices or (100, 1000, 10000):
+        fleet = FakeFleet(count, port, size, latency, fail_rate, change_rate).start()
+        workdir = tempfile.mkdtemp(prefix='nbmon-bench-{}-'.format(count))
+        try:
+            with open(os.path.join(workdir, 'inventory.json'), 'w') as f:
+                json.dump(fleet.inventory(), f)
+            nbmon(workdir, '-f', 'inventory.json')
+
+            direct = time_get_config(fleet)
+            click.echo('{} devices, {} workers: get_config() p50 {:.3f}s p99 {:.3f}s'.format(
+                count, workers, percentile(direct, 0.5), percentile(direct, 0.99)))
+
+            for number in range(1, sweeps + 1):
+                before = db_size(workdir)
+                #same format sqlalchemy stores datetimes in
+                since = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+                elapsed, rss = nbmon(workdir, '-d', '-w', str(workers))
+                polls, failed, latencies = sweep_stats(workdir, since)
+                click.echo('  sweep {}: {:.1f} devices/sec  p50 {:.3f}s  p99 {:.3f}s  failed {}  '
+                    'db growth {:.1f} MB  peak rss {:.1f} MB  ({} polls in {:.1f}s)'.format(
+                    number, polls / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99), failed,
+                    (db_size(workdir) - before) / 1048576.0, rss / 1024.0, polls, elapsed))
+        finally:
+            fleet.stop()
+            if keep:
+                click.echo('  kept {}'.format(workdir))
+            else:
+                shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    bench()
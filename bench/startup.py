@@ -0,0 +1,91 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    startup.py -> startup time of short lived nbmon commands
+
+    Each command is run repeatedly as a fresh process in a scratch directory
+    holding a small database.  The median and best wall times are reported
+    with the heavy modules (sqlalchemy, netmiko, paramiko, cryptography) the
+    command ended up importing.
+
+    Example
+        python bench/startup.py --runs 20
+
+    Copyright 2017 Ron Wellman
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import click
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ('sqlalchemy', 'netmiko', 'paramiko', 'cryptography')
+
+COMMANDS = (['--help'],
+            ['--status', '--format', 'json'],
+            ['--status', '--only-missed', '--format', 'csv'],
+            ['--metrics', '-', '--metrics-format', 'json'])
+
+#runs nbmon.py in the child and writes the heavy modules it imported to argv[1]
+WRAPPER = '''
+import json, runpy, sys
+report = sys.argv[1]
+sys.argv = sys.argv[2:]
+sys.path.insert(0, {repo!r})
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+with open(report, 'w') as f:
+    json.dump([m for m in {heavy!r} if m in sys.modules], f)
+'''
+
+def run(workdir, args):
+    '''
+        runs nbmon.py once, returns (wall seconds, heavy modules imported)
+    '''
+    report = os.path.join(workdir, 'modules.json')
+    wrapper = WRAPPER.format(repo=REPO, heavy=HEAVY)
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        subprocess.check_call([sys.executable, '-W', 'ignore', '-c', wrapper, report,
+            os.path.join(REPO, 'nbmon.py')] + args, cwd=workdir, stdout=devnull, stderr=devnull)
+        elapsed = time.time() - started
+    with open(report) as f:
+        return elapsed, json.load(f)
+
+@click.command()
+@click.option('--runs', help='runs per command', type=click.IntRange(1, None), default=10)
+@click.option('--devices', help='devices in the scratch database', type=click.IntRange(0, None), default=100)
+def startup(runs, devices):
+    '''
+        reports how long short lived nbmon commands take to start and finish
+    '''
+    workdir = tempfile.mkdtemp(prefix='nbmon-startup-')
+    try:
+        with open(os.path.join(workdir, 'inventory.json'), 'w') as f:
+            json.dump({'devices': [{'device_type': 'cisco_ios', 'ip': '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+                'username': 'u', 'password': 'p', 'description': 'device {}'.format(i)} for i in range(devices)]}, f)
+        #the first run also creates the schema, it is not counted
+        run(workdir, ['-f', 'inventory.json'])
+
+        click.echo('{:<45} {:>9} {:>9}  {}'.format('COMMAND', 'MEDIAN', 'BEST', 'HEAVY IMPORTS'))
+        for args in COMMANDS:
+            times = []
+            for i in range(runs):
+                elapsed, modules = run(workdir, args)
+                times.append(elapsed)
+            times.sort()
+            click.echo('{:<45} {:>8.0f}ms {:>7.0f}ms  {}'.format('nbmon.py ' + ' '.join(args),
+                times[len(times) // 2] * 1000, times[0] * 1000, ', '.join(modules) or '-'))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    startup()
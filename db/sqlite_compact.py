@@ -0,0 +1,127 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    sqlite_compact.py -> config history retention
+
+    Retention policy:
+        every config newer than keep_all days is kept
+        older than that, the last config of each day is kept up to keep_daily days
+        older than that, the last config of each month is kept
+        the first and latest config of a device are always kept
+        poll_history rows are kept for keep_all days
+
+    Compaction works through the devices a few configs at a time so it can be
+    interleaved with polling, and returns freed pages with incremental
+    vacuum instead of rewriting the whole file.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import sqlite_query as db
+from sqlite_gen import Config, Device
+
+def expired_configs(rows, now, keep_all, keep_daily):
+    '''
+        returns the config_ids from (config_id, timestamp) rows, oldest first, that
+        the retention policy no longer keeps
+    '''
+    if not rows:
+        return []
+
+    keep = set([rows[0][0], rows[-1][0]])
+    latest_in_bucket = {}
+    for config_id, timestamp in rows:
+        age = now - timestamp
+        if age <= keep_all:
+            keep.add(config_id)
+        elif age <= keep_daily:
+            latest_in_bucket[('day', timestamp.date())] = config_id
+        else:
+            latest_in_bucket[('month', timestamp.year, timestamp.month)] = config_id
+    keep.update(latest_in_bucket.values())
+
+    return [config_id for config_id, timestamp in rows if config_id not in keep]
+
+def enable_incremental_vacuum():
+    '''
+        switches an existing database file to incremental vacuum, a one time full VACUUM
+    '''
+    engine = db.session.get_bind(Config)
+    if engine.dialect.name != 'sqlite':
+        return
+    if engine.execute('PRAGMA auto_vacuum').scalar() != 2:
+        engine.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        engine.execute('VACUUM')
+
+class Compactor(object):
+    '''
+        applies the retention policy a bounded number of configs at a time
+    '''
+
+    def __init__(self, keep_all=30, keep_daily=365, budget=50, devices=200, vacuum_pages=256, every=86400):
+        self.keep_all = datetime.timedelta(days=keep_all)
+        self.keep_daily = datetime.timedelta(days=keep_daily)
+        self.budget = budget
+        self.devices = devices
+        self.vacuum_pages = vacuum_pages
+        self.every = datetime.timedelta(seconds=every)
+        self.device_id = 0
+        self.deleted = 0
+        #no new pass is started before this time
+        self.resume = None
+
+    def step(self):
+        '''
+            deletes at most budget expired configs from at most devices devices,
+            returns True once a full pass over the devices has finished
+
+            after a pass further steps do nothing until every seconds have passed
+        '''
+        now = datetime.datetime.utcnow()
+        if self.resume is not None and now < self.resume:
+            return True
+
+        remaining = self.budget
+        scanned = 0
+        finished = False
+
+        while remaining > 0 and scanned < self.devices:
+            scanned += 1
+            device_id = db.session.query(Device.device_id).filter(Device.device_id > self.device_id).\
+                order_by(Device.device_id).limit(1).scalar()
+            if device_id is None:
+                self.device_id = 0
+                self.resume = now + self.every
+                finished = True
+                #poll timings are only kept as long as every config is
+                db.prune_poll_history(now - self.keep_all)
+                break
+
+            rows = db.session.query(Config.config_id, Config.timestamp).\
+                filter(Config.device_id == device_id).order_by(Config.timestamp).all()
+            expired = expired_configs(rows, now, self.keep_all, self.keep_daily)
+
+            batch = expired[:remaining]
+            for config_id in batch:
+                db.delete_config(db.session.query(Config).get(config_id))
+            remaining -= len(batch)
+            self.deleted += len(batch)
+
+            #move on once this device is done, otherwise pick it up again next step
+            if len(batch) == len(expired):
+                self.device_id = device_id
+
+        db.commit()
+        if db.session.get_bind(Config).dialect.name == 'sqlite':
+            db.session.execute('PRAGMA incremental_vacuum({})'.format(self.vacuum_pages), mapper=Config)
+        return finished
+
+    def run(self):
+        '''
+            applies the retention policy to every device, returns the number of configs deleted
+        '''
+        self.resume = None
+        while not self.step():
+            pass
+        return self.deleted
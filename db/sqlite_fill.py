@@ -3,34 +3,144 @@
 '''
     sqlite_fill.py -> inserts devices into the database
 
+    The inventory file is parsed one device at a time and synced in batches
+    keyed on ip + port, so loading the same file twice changes nothing and
+    large inventories never sit in memory whole.
+
     Copyright 2017 Ron Wellman
 '''
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from db.sqlite_gen import Base, Device, Config
+from db.sqlite_gen import Device, Config
+from db.sqlite_query import get_session
+from collections import OrderedDict
 import json
+import re
+
+#fields taken from the inventory file when a device already exists
+FIELDS = ('device_type', 'description', 'username', 'password', 'secret',
+    'actively_poll', 'poll_interval', 'priority')
+
+DEVICES = re.compile(r'"devices"\s*:\s*\[')
 
-def load_database(inputfile):
+def iter_devices(inputfile, chunk_size=65536):
     '''
-        reads in a json formatted file, creates a new device object, and inserts it into the database
+        generator that parses the "devices" array of a json inventory file one device at a time
     '''
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    #find the start of the devices array
+    while True:
+        match = DEVICES.search(buf)
+        if match:
+            pos = match.end()
+            break
+        if eof:
+            raise ValueError('no "devices" array found in {}'.format(inputfile.name))
+        data = inputfile.read(chunk_size)
+        eof = not data
+        buf += data
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == ']':
+            return
 
-    engine = create_engine('sqlite:///nbmon.db')
+        try:
+            if pos >= len(buf):
+                raise ValueError('need more data')
+            device, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            #the next device is split across reads
+            if eof:
+                raise ValueError('truncated "devices" array in {}'.format(inputfile.name))
+            data = inputfile.read(chunk_size)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+
+        yield device
+
+        #drop what has already been parsed
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+def device_values(device):
+    '''
+        returns the inventory fields of a device with defaults for the optional ones
+    '''
+    return {'device_type': device['device_type'],
+            'description': device.get('description'),
+            'username': device['username'],
+            'password': device['password'],
+            'secret': device.get('secret'),
+            'actively_poll': device.get('actively_poll', True),
+            'poll_interval': device.get('poll_interval'),
+            'priority': device.get('priority', 0)}
+
+def sync_devices(session, devices, counts):
+    '''
+        inserts new devices and updates changed ones in bulk, keyed on ip + port
+    '''
+    #later entries for the same ip + port win, file order is kept for new device ids
+    wanted = OrderedDict()
+    for device in devices:
+        wanted[(device['ip'], device.get('port', 22))] = device
+
+    existing = {}
+    columns = [Device.device_id, Device.ip, Device.port] + [getattr(Device, f) for f in FIELDS]
+    ips = set(ip for ip, port in wanted)
+    for row in session.query(*columns).filter(Device.ip.in_(ips)).order_by(Device.device_id):
+        existing.setdefault((row.ip, row.port), row)
+
+    inserts = []
+    updates = []
+    for (ip, port), device in wanted.items():
+        values = device_values(device)
+        row = existing.get((ip, port))
+        if row is None:
+            values.update(ip=ip, port=port, missed_polls=device.get('missed_polls', 0),
+                config_changes=device.get('config_changes', 0))
+            inserts.append(values)
+        elif any(getattr(row, f) != values[f] for f in FIELDS):
+            values['device_id'] = row.device_id
+            updates.append(values)
+        else:
+            counts['unchanged'] += 1
+
+    session.bulk_insert_mappings(Device, inserts)
+    session.bulk_update_mappings(Device, updates)
+    session.commit()
+    counts['added'] += len(inserts)
+    counts['changed'] += len(updates)
+
+def load_database(inputfile, batch=500):
+    '''
+        reads in a json formatted file and adds or updates its devices in the database,
+        returns a dictionary counting the devices added, changed, and unchanged
+
+        poll_interval (seconds) and priority are optional per device
+    '''
 
-    Base.metadata.bind = engine
+    session = get_session()
 
-    DBSession = sessionmaker(bind=engine)
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+    devices = []
 
-    session = DBSession()
+    for device in iter_devices(inputfile):
+        devices.append(device)
+        if len(devices) >= batch:
+            sync_devices(session, devices, counts)
+            devices = []
 
-    load = json.load(inputfile)
+    if devices:
+        sync_devices(session, devices, counts)
 
-    for device in load['devices']:
-        new_device = Device(ip=device['ip'],port=device['port'],description=device['description'],
-            username=device['username'],password=device['password'],
-            actively_poll=device['actively_poll'],device_type=device['device_type'],
-            secret=device['secret'],missed_polls=device['missed_polls'],
-            config_changes=device['config_changes'])
-        session.add(new_device)
-        session.commit()
+    session.close()
+    return counts
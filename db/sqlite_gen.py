@@ -17,32 +17,138 @@
             last_seen   - DateTime
             missed_polls    - Integer
             config_changes  - Integer
+            poll_interval   - Integer   - seconds, NULL uses the daemon default
+            priority    - Integer
+            next_poll   - DateTime
+            last_change - DateTime
+            latest_config_id    - Integer   - newest config of the device
+            latest_hconfig      - String    - hconfig of the newest config (of its normalized body
+                                              when it was stored before normalization)
+            latest_version      - Integer   - highest version ever stored (NULL until first looked up)
+            probe_marker    - String    - change marker seen by the last full fetch (see utils.probes)
+            full_fetched    - DateTime  - when the full config was last fetched
+            fetch_time  - Float     - smoothed seconds a full config fetch takes (see utils.profiles)
 
         config
             config_id   - Integer   - pk
             device_id   - Integer   - fk
             timestamp   - DateTime
-            hconfig     - String
-            config_id   - Text
+            hconfig     - String    - sha512 of the config, key into config_blob
+            config      - Text      - inline body (legacy rows only, empty once stored in config_blob)
+            version     - Integer   - 1 for the first config of a device, counting up
+            delta       - LargeBinary   - compressed reverse delta, NULL for full configs
+            delta_base  - Integer   - config_id of the newer config the delta applies to
+            diff        - LargeBinary   - zlib compressed unified diff from the previous config
+            diff_base   - Integer   - config_id of the previous config when the diff was taken
+            indexed     - Boolean   - body is in config_fts, NULL rows are scanned by --search
+            body_id     - Integer   - config_fts rowid of the body, shared by identical configs
+                                          (the config_id of the first config indexed with it)
+
+        lease
+            device_id   - Integer   - pk
+            owner       - String    - worker currently polling the device
+            expires     - DateTime  - after this the device can be claimed again
+
+        poll_history
+            poll_id     - Integer   - pk
+            device_id   - Integer
+            timestamp   - DateTime  - when the poll finished
+            outcome     - String    - changed, unchanged, probed (change marker unchanged) or failed
+            error       - String    - exception class of a failed poll
+            connect_time    - Float     - seconds to open (or borrow) the ssh session
+            fetch_time  - Float     - seconds running the show command
+            hash_time   - Float     - seconds normalizing and hashing the config
+            persist_time    - Float     - seconds spent on database writes
+            size        - Integer   - length of the config as received
+
+        setting
+            name        - String    - pk
+            value       - String    - e.g. history (full or delta) and keyframe, see sqlite_query
+
+        config_fts (sqlite fts5, contentless, no positions, rowid = config.body_id,
+                    trigram tokenizer where available)
+            body        - full text index of one distinct config body
+
+        config_blob
+            hconfig     - String    - pk
+            codec       - String    - zlib, lzma or none
+            size        - Integer   - uncompressed length
+            body        - LargeBinary
+
+    Indexes:
+        device(ip, port)
+        config(device_id, timestamp)
+        config(timestamp)
+        config(hconfig)
+        poll_history(timestamp)
+        poll_history(device_id, timestamp)
 
     Relationships:
         Device.configs  -> Config
         Config.device   -> Device
+        Config.blob     -> ConfigBlob (by hconfig, shared by identical configs)
+
+    History:
+        The latest config of a device is always stored in full.  In delta
+        mode older configs keep only a reverse delta against the next newer
+        config, except every KEYFRAME_INTERVAL-th version which stays in full
+        so rebuilding an old config never walks more than that many deltas.
 
     Copyright 2017 Ron Wellman
 '''
 
-from sqlalchemy import Table, Column, ForeignKey, desc
-from sqlalchemy import Text, Integer, String, Boolean, DateTime
+from sqlalchemy import Table, Column, ForeignKey, Index, desc
+from sqlalchemy import Text, Integer, String, Boolean, DateTime, LargeBinary, Float
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, foreign, object_session, deferred
+from sqlalchemy import create_engine, inspect, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from difflib import SequenceMatcher
 import datetime
+import json
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+#codec used for newly stored config bodies
+COMPRESSION = 'zlib'
+
+def compress(text, codec=None):
+    '''
+        returns a (codec, data) tuple holding the compressed utf-8 encoding of text
+    '''
+    codec = codec or COMPRESSION
+    data = text.encode('utf-8')
+    if codec == 'zlib':
+        return codec, zlib.compress(data, 9)
+    elif codec == 'lzma' and lzma is not None:
+        return codec, lzma.compress(data)
+    return 'none', data
+
+def decompress(codec, data):
+    '''
+        reverses compress()
+    '''
+    data = bytes(data)
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'lzma':
+        data = lzma.decompress(data)
+    return data.decode('utf-8')
 
 Base = declarative_base()
 
 class Device(Base):
     __tablename__ = 'device'
+    __table_args__ = (Index('ix_device_ip_port', 'ip', 'port'),)
     device_id = Column(Integer, primary_key=True)
     device_type = Column(String(32), nullable=False)
     ip = Column(String(19), nullable=False)
@@ -55,17 +161,275 @@ class Device(Base):
     last_seen = Column(DateTime)
     missed_polls = Column(Integer)
     config_changes = Column(Integer)
+    poll_interval = Column(Integer)
+    priority = Column(Integer, default=0)
+    next_poll = Column(DateTime)
+    last_change = Column(DateTime)
+    latest_config_id = Column(Integer)
+    latest_hconfig = Column(String(128))
+    latest_version = Column(Integer)
+    probe_marker = Column(String(255))
+    full_fetched = Column(DateTime)
+    fetch_time = Column(Float)
+
+class ConfigBlob(Base):
+    __tablename__ = 'config_blob'
+    hconfig = Column(String(128), primary_key=True)
+    codec = Column(String(8), nullable=False)
+    size = Column(Integer)
+    body = Column(LargeBinary, nullable=False)
+
+    @property
+    def text(self):
+        '''
+            decompressed config body
+        '''
+        return decompress(self.codec, self.body)
 
 class Config(Base):
     __tablename__ = 'config'
+    __table_args__ = (Index('ix_config_device_timestamp', 'device_id', 'timestamp'),
+                      Index('ix_config_timestamp', 'timestamp'),
+                      Index('ix_config_hconfig', 'hconfig'))
     config_id = Column(Integer, primary_key=True)
     device_id = Column(Integer, ForeignKey('device.device_id'))
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
     hconfig = Column(String(128), nullable=False)
-    config = Column(Text, nullable=False)
+    #bodies are only read when a config is actually viewed
+    inline = deferred(Column('config', Text, nullable=False, default=''))
+    version = Column(Integer)
+    delta = deferred(Column(LargeBinary))
+    delta_base = Column(Integer)
+    diff = deferred(Column(LargeBinary))
+    diff_base = Column(Integer)
+    indexed = Column(Boolean)
+    body_id = Column(Integer)
     device = relationship(Device, back_populates="configs")
+    blob = relationship(ConfigBlob, primaryjoin=foreign(hconfig) == ConfigBlob.hconfig, viewonly=True)
+
+    @property
+    def config(self):
+        '''
+            config body, loaded and decompressed from config_blob on first access
+            or rebuilt from the newer config it is a delta against
+        '''
+        if self.inline:
+            return self.inline
+        if self.blob is not None:
+            return self.blob.text
+        if self.delta is not None:
+            base = object_session(self).query(Config).get(self.delta_base)
+            return apply_delta(base.config, self.delta)
+        return self.inline
 
 Device.configs = relationship(Config, order_by=desc(Config.timestamp), back_populates="device")
 
-engine = create_engine("sqlite:///nbmon.db")
-Base.metadata.create_all(engine)
+class Lease(Base):
+    __tablename__ = 'lease'
+    device_id = Column(Integer, primary_key=True)
+    owner = Column(String(128), nullable=False)
+    expires = Column(DateTime, nullable=False)
+
+class PollHistory(Base):
+    __tablename__ = 'poll_history'
+    __table_args__ = (Index('ix_poll_history_timestamp', 'timestamp'),
+                      Index('ix_poll_history_device_timestamp', 'device_id', 'timestamp'))
+    poll_id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    outcome = Column(String(16), nullable=False)
+    error = Column(String(64))
+    connect_time = Column(Float)
+    fetch_time = Column(Float)
+    hash_time = Column(Float)
+    persist_time = Column(Float)
+    size = Column(Integer)
+
+class Setting(Base):
+    __tablename__ = 'setting'
+    name = Column(String(64), primary_key=True)
+    value = Column(String(255))
+
+def make_delta(base, target):
+    '''
+        returns a compressed delta that rebuilds target from base
+
+        the delta is a list of [start, end] line ranges copied from base and
+        literal lines taken from target
+    '''
+    base_lines = base.split('\n')
+    target_lines = target.split('\n')
+    ops = []
+    matcher = SequenceMatcher(None, base_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        else:
+            ops.extend(target_lines[j1:j2])
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'), 9)
+
+def apply_delta(base, delta):
+    '''
+        rebuilds the target text of make_delta() from base
+    '''
+    base_lines = base.split('\n')
+    lines = []
+    for op in json.loads(zlib.decompress(bytes(delta)).decode('utf-8')):
+        if isinstance(op, list):
+            lines.extend(base_lines[op[0]:op[1]])
+        else:
+            lines.append(op)
+    return '\n'.join(lines)
+
+def upgrade(engine):
+    '''
+        adds columns and indexes introduced after the database file was first created,
+        and fills in device.last_change where it was never recorded
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, column.name,
+                    column.type.compile(engine.dialect)))
+
+        indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+    #--changed-since and the scheduler go by last_change, which devices stored
+    #before it was kept only have through their configs
+    engine.execute('UPDATE device SET last_change = (SELECT max(timestamp) FROM config '
+        'WHERE config.device_id = device.device_id) WHERE last_change IS NULL')
+
+def tune_sqlite(dbapi_connection, connection_record):
+    '''
+        pragmas applied to every new sqlite connection
+
+        WAL lets --status and other readers run while the daemon is writing,
+        synchronous=NORMAL is durable in WAL mode with one fsync per checkpoint
+        instead of per commit, and busy_timeout waits out a competing writer
+        instead of failing with "database is locked"
+
+        auto_vacuum only takes effect on a new file, or after the one time full
+        VACUUM done by sqlite_compact.enable_incremental_vacuum()
+    '''
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=30000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-16000')
+    cursor.close()
+
+#used when neither --db-url nor NBMON_DB_URL is given
+DEFAULT_URL = 'sqlite:///nbmon.db'
+
+def database_url(database=None):
+    '''
+        returns the database url to use: the one given, NBMON_DB_URL, or DEFAULT_URL
+    '''
+    return database or os.environ.get('NBMON_DB_URL') or DEFAULT_URL
+
+def get_engine(database=None, pool_size=5, max_overflow=10, pool_recycle=3600):
+    '''
+        returns a pooled engine for the database url (see database_url())
+
+        sqlite files get the pragmas from tune_sqlite() and a connection pool
+        instead of sqlalchemy's default of reconnecting (and re-running the
+        pragmas) for every transaction; other backends get a pool that
+        recycles connections before server side idle timeouts close them
+    '''
+    url = make_url(database_url(database))
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            #an in-memory database only exists on its own connection
+            engine = create_engine(url)
+        else:
+            #pooled connections are handed between threads, only one thread uses one at a time
+            engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                connect_args={'timeout': 30, 'check_same_thread': False})
+        event.listen(engine, 'connect', tune_sqlite)
+        return engine
+
+    return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle)
+
+def index_tokenizer(connectable):
+    '''
+        returns how config_fts splits config bodies: 'trigram' (every substring
+        can be looked up), 'words' (whole words only), or False without an index
+    '''
+    sql = connectable.execute("SELECT sql FROM sqlite_master WHERE name = 'config_fts'").scalar()
+    if sql is None:
+        return False
+    return 'trigram' if 'trigram' in sql else 'words'
+
+def create_search_index(connectable, rebuild=False):
+    '''
+        creates the full text index over config bodies, returns its index_tokenizer()
+
+        the trigram tokenizer (sqlite 3.34 and later) is used where available,
+        older sqlite builds get an index of whole words; rebuild drops an
+        existing index first so it is created with the best tokenizer
+
+        no token positions or sizes are kept (detail='none', columnsize=0), which
+        keeps the index a fraction of the compressed bodies
+    '''
+    if connectable.dialect.name != 'sqlite':
+        return False
+    if rebuild:
+        connectable.execute('DROP TABLE IF EXISTS config_fts')
+    #contentless: only the index is stored, the bodies stay compressed in config_blob
+    for tokenizer in (", tokenize='trigram'", ''):
+        try:
+            connectable.execute("CREATE VIRTUAL TABLE IF NOT EXISTS config_fts USING fts5(body, content=''{}, "
+                "detail='none', columnsize=0)".format(tokenizer))
+            break
+        except Exception:
+            pass
+    return index_tokenizer(connectable)
+
+#bump whenever a table, column, or index is added so existing files get upgraded once
+SCHEMA_VERSION = 7
+
+#set by init_db(), search_index is the index_tokenizer() of config_fts
+engine = None
+search_index = False
+
+def init_db(database=None):
+    '''
+        connects to the database and brings its schema up to date, returns the engine
+
+        done once per process on first use, every later call returns the same
+        engine; an sqlite file already stamped with SCHEMA_VERSION skips
+        create_all() and upgrade() altogether
+    '''
+    global engine, search_index
+    if engine is not None:
+        return engine
+
+    new_engine = get_engine(database)
+    sqlite = new_engine.dialect.name == 'sqlite'
+    if not sqlite or new_engine.execute('PRAGMA user_version').scalar() != SCHEMA_VERSION:
+        Base.metadata.create_all(new_engine)
+        upgrade(new_engine)
+        fts = new_engine.execute("SELECT sql FROM sqlite_master WHERE name = 'config_fts'").scalar() if sqlite else None
+        if fts is not None and 'detail' not in fts:
+            #older indexes kept every config row (or every line) with positions, configs
+            #are scanned by --search until --reindex indexes each distinct body once
+            for table in ('config_fts', 'search_span', 'search_line'):
+                new_engine.execute('DROP TABLE IF EXISTS {}'.format(table))
+            new_engine.execute('DROP INDEX IF EXISTS ix_config_device_version')
+            new_engine.execute('UPDATE config SET indexed = NULL')
+        search_index = create_search_index(new_engine)
+        if sqlite:
+            new_engine.execute('PRAGMA user_version={}'.format(SCHEMA_VERSION))
+    else:
+        search_index = index_tokenizer(new_engine)
+
+    Base.metadata.bind = new_engine
+    engine = new_engine
+    return engine
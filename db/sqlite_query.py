@@ -3,36 +3,192 @@
 '''
     sqlite_query.py -> interacts with the database
 
+    Nothing touches the database on import, the session below connects and
+    checks the schema (sqlite_gen.init_db()) the first time it is used.  The
+    database is sqlite:///nbmon.db unless init_db() is called first with
+    another url or NBMON_DB_URL is set; each thread gets its own session from
+    the engine's connection pool.
+
     Copyright 2017 Ron Wellman
 '''
 
-from sqlalchemy import create_engine, text, desc, delete
-from sqlalchemy.orm import sessionmaker
-from sqlite_gen import Base, Device, Config
+from sqlalchemy import text, desc, delete, select, literal, or_, func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, scoped_session, undefer, aliased
+import sqlite_gen
+from sqlite_gen import Base, Device, Config, ConfigBlob, Lease, PollHistory, Setting, compress, decompress, make_delta, init_db
+import datetime
+import re
+from utils.diffs import cached_diff, unified, label
+import time
+
+#how the history of a device is stored: 'full' keeps every config in full,
+#'delta' keeps reverse deltas with a full keyframe every KEYFRAME_INTERVAL versions;
+#both are kept in the setting table and loaded by load_history_settings()
+HISTORY = 'full'
+KEYFRAME_INTERVAL = 16
+
+#sessions share the one engine (and its connection pool) created by init_db()
+DBSession = sessionmaker()
+
+def get_session():
+    '''
+        returns a new session to the database configured with init_db()
+    '''
+    return DBSession(bind=init_db())
+
+class WriteBatch(object):
+    '''
+        groups the writes of many helpers into one transaction, committed after
+        size polls (counted by poll_done()) or window seconds, whichever comes first
+    '''
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.pending = 0
+        self.dirty = False
+        self.started = time.time()
+
+    def due(self):
+        return self.pending >= self.size or (self.dirty and time.time() - self.started >= self.window)
+
+    def commit(self):
+        session.commit()
+        self.pending = 0
+        self.dirty = False
+        self.started = time.time()
+
+#open WriteBatch, None commits after every helper
+batch = None
+
+def begin_batch(size=200, window=5.0):
+    '''
+        starts grouping helper writes into batched transactions
+    '''
+    global batch
+    batch = WriteBatch(size, window)
+
+def flush_batch(force=False):
+    '''
+        commits the open batch if it is full or its time window has passed
+    '''
+    if batch is not None and (force or batch.due()):
+        batch.commit()
+
+def end_batch():
+    '''
+        commits any outstanding writes and returns to a commit per helper
+    '''
+    global batch
+    if batch is not None:
+        batch.commit()
+    batch = None
+
+def commit():
+    '''
+        commits the work of a helper, or defers it to the open batch
+    '''
+    if batch is None:
+        session.commit()
+    else:
+        batch.dirty = True
+        flush_batch()
+
+def poll_done():
+    '''
+        counts a recorded poll towards the open batch, called once the last
+        helper of the poll has run so a poll is never split across transactions
+    '''
+    if batch is not None:
+        batch.pending += 1
+        batch.dirty = True
+        flush_batch()
 
-def get_session(database='sqlite:///nbmon.db'):
+def windowed(query, window=500):
     '''
-        returns a session object to the database (defaulted to sqlite:///nbmon.db)
+        generator over the devices of a query in device_id order, fetched window
+        rows at a time by keyset (device_id > last seen) instead of all at once
+
+        once the caller moves past a window its devices are flushed and expunged,
+        so the session never holds much more than one window however large the
+        fleet; changes made through the helpers are kept (flushed, committed
+        with the transaction)
     '''
-    engine = create_engine(database)
-    Base.metadata.bind = engine
-    DBSession = sessionmaker()
-    DBSession.bind = engine
-    return DBSession()
+    last = 0
+    while True:
+        devices = query.filter(Device.device_id > last).order_by(Device.device_id).limit(window).all()
+        if not devices:
+            return
+        for device in devices:
+            yield device
+        last = devices[-1].device_id
+        session.flush()
+        for device in devices:
+            if device in session:
+                session.expunge(device)
 
 def next_device():
     '''
         generator that returns all devices in the database
     '''
-    for device in session.query(Device):
-        yield device
+    return windowed(session.query(Device))
 
 def next_active_device():
     '''
         generator that returns all the active devices in the database
     '''
-    for device in session.query(Device).filter(Device.actively_poll == True):
-        yield device
+    return windowed(session.query(Device).filter(Device.actively_poll == True))
+
+def claim_devices(owner, count, ttl, retries=5):
+    '''
+        leases up to count active devices that are due for polling to owner and
+        returns them, most overdue first
+
+        a device is never leased to two workers at once; a lease that is not
+        released within ttl seconds (e.g. the worker crashed) expires and the
+        device can be claimed by another worker
+    '''
+    #outstanding writes are committed so the claim is its own short transaction
+    flush_batch(force=True)
+    session.commit()
+
+    for attempt in range(retries):
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=ttl)
+        leased = select([Lease.device_id])
+        due = select([Device.device_id, literal(owner), literal(expires)]).\
+            where(Device.actively_poll == True).\
+            where(or_(Device.next_poll == None, Device.next_poll <= now)).\
+            where(~Device.device_id.in_(leased)).\
+            order_by(Device.next_poll).limit(count)
+        try:
+            session.execute(Lease.__table__.delete().where(Lease.expires < now), mapper=Lease)
+            session.execute(Lease.__table__.insert().from_select(['device_id', 'owner', 'expires'], due), mapper=Lease)
+            session.commit()
+            break
+        except DBAPIError:
+            #another worker claimed some of the same devices first
+            session.rollback()
+    else:
+        return []
+
+    return session.query(Device).join(Lease, Lease.device_id == Device.device_id).\
+        filter(Lease.owner == owner, Lease.expires == expires).all()
+
+def release_device(device, owner):
+    '''
+        gives up the lease on a device once it has been polled
+    '''
+    session.query(Lease).filter(Lease.device_id == device.device_id, Lease.owner == owner).\
+        delete(synchronize_session=False)
+    commit()
+
+def get_device(device_id):
+    '''
+        returns the device with the given id or None
+    '''
+    return session.query(Device).get(device_id)
 
 def next_config(device):
     '''
@@ -41,49 +197,559 @@ def next_config(device):
     for config in device.configs:
         yield config
 
-def next_missed_device():
+def find_device(reference):
     '''
-        generator that returns devices with missed_polls
+        returns the device with the given device_id or ip, or None
+    '''
+    if reference.isdigit():
+        return get_device(int(reference))
+    return session.query(Device).filter(Device.ip == reference).order_by(Device.device_id).first()
+
+def device_configs(device, since=None, until=None):
     '''
-    for device in session.query(Device).filter(Device.actively_poll == True).order_by(Device.missed_polls.desc(),Device.config_changes.desc()):
-        yield device
+        query over the configs of a device, optionally stored within [since, until]
+
+        served by the config(device_id, timestamp) index, Device.configs is never loaded
+    '''
+    query = session.query(Config).filter(Config.device_id == device.device_id)
+    if since is not None:
+        query = query.filter(Config.timestamp >= since)
+    if until is not None:
+        query = query.filter(Config.timestamp <= until)
+    return query
+
+def config_as_of(device, ts):
+    '''
+        returns the config the device was running at a point in time, i.e. the
+        newest stored at or before it, or None
+    '''
+    return device_configs(device, until=ts).order_by(Config.timestamp.desc()).limit(1).first()
+
+def nth_config(device, n):
+    '''
+        returns the n-th newest config of a device (0 is the latest), or None
+    '''
+    return device_configs(device).order_by(Config.timestamp.desc()).offset(n).limit(1).first()
+
+def config_count(device, since=None, until=None):
+    '''
+        returns the number of configs of a device, optionally stored within [since, until]
+    '''
+    return device_configs(device, since, until).with_entities(func.count(Config.config_id)).scalar()
+
+def config_versions(device, since=None, until=None):
+    '''
+        generator over (config_id, version, timestamp, hconfig) of the configs of a
+        device within [since, until], oldest first; no bodies are read
+    '''
+    query = device_configs(device, since, until).with_entities(Config.config_id, Config.version,
+        Config.timestamp, Config.hconfig).order_by(Config.timestamp)
+    for row in query.yield_per(500):
+        yield row
+
+def version_counts(since=None, until=None):
+    '''
+        generator over (device_id, ip, description, configs, first, last) for every
+        device with configs stored within [since, until]
+    '''
+    query = session.query(Device.device_id, Device.ip, Device.description, func.count(Config.config_id),
+        func.min(Config.timestamp), func.max(Config.timestamp)).\
+        join(Config, Config.device_id == Device.device_id)
+    if since is not None:
+        query = query.filter(Config.timestamp >= since)
+    if until is not None:
+        query = query.filter(Config.timestamp <= until)
+    for row in query.group_by(Device.device_id).order_by(Device.device_id).yield_per(500):
+        yield row
+
+def status_rows(only_missed=False, changed_since=None, limit=None):
+    '''
+        generator over the status columns of active devices, worst first
+
+        only the displayed columns are selected, no Device objects are built
+    '''
+    query = session.query(Device.device_id, Device.ip, Device.description, Device.last_seen,
+        Device.last_change, Device.missed_polls, Device.config_changes).\
+        filter(Device.actively_poll == True)
+    if only_missed:
+        query = query.filter(Device.missed_polls > 0)
+    if changed_since is not None:
+        query = query.filter(Device.last_change >= changed_since)
+    query = query.order_by(Device.missed_polls.desc(), Device.config_changes.desc())
+    if limit:
+        query = query.limit(limit)
+
+    for row in query.yield_per(500):
+        yield row
+
+def latest_config_rows():
+    '''
+        generator over (device_id, ip, port, config_id, hconfig) of the newest
+        config of every device that has one, in device_id order
+
+        only these columns are selected, config bodies are read separately with
+        config_body()
+    '''
+    query = session.query(Device.device_id, Device.ip, Device.port, Device.latest_config_id,
+        Device.latest_hconfig, Device.latest_version).order_by(Device.device_id)
+    for row in query.yield_per(500):
+        config_id, hconfig = row.latest_config_id, row.latest_hconfig
+        if row.latest_version is None:
+            #stored before devices pointed at their newest config
+            latest = session.query(Config.config_id, Config.hconfig).filter(Config.device_id == row.device_id).\
+                order_by(Config.timestamp.desc()).first()
+            if latest is not None:
+                config_id, hconfig = latest
+        if config_id is not None:
+            yield row.device_id, row.ip, row.port, config_id, hconfig
+
+def config_body(config_id):
+    '''
+        returns the text of a single config
+
+        a full config is read straight from config_blob without building any
+        orm objects, deltas and legacy inline rows go through Config.config
+    '''
+    blob = session.query(ConfigBlob.codec, ConfigBlob.body).\
+        join(Config, Config.hconfig == ConfigBlob.hconfig).\
+        filter(Config.config_id == config_id, Config.delta == None).first()
+    if blob is not None:
+        return decompress(blob.codec, blob.body)
+    return session.query(Config).get(config_id).config
+
+def store_blob(hconf, conf):
+    '''
+        adds the compressed config body to config_blob unless an identical config is already stored
+    '''
+    if session.query(ConfigBlob.hconfig).filter(ConfigBlob.hconfig == hconf).first() is None:
+        codec, body = compress(conf)
+        session.add(ConfigBlob(hconfig=hconf, codec=codec, size=len(conf), body=body))
+
+def drop_blob(hconf):
+    '''
+        removes a config body once no full config row refers to it
+    '''
+    if session.query(Config.config_id).filter(Config.hconfig == hconf, Config.delta == None).first() is None:
+        session.query(ConfigBlob).filter(ConfigBlob.hconfig == hconf).delete(synchronize_session=False)
+
+def demote_config(config, base, base_text):
+    '''
+        replaces a full config with a reverse delta against the next newer config
+        (base) unless it is a keyframe
+    '''
+    if config.delta is not None or config.inline or not config.version:
+        return
+    if config.version % KEYFRAME_INTERVAL == 0:
+        return
+    config.delta = make_delta(base_text, config.config)
+    config.delta_base = base.config_id
+    session.flush()
+    drop_blob(config.hconfig)
+
+def refresh_latest(device, keep_version=False):
+    '''
+        points the device at its newest stored config
+
+        only needed for devices stored before the pointer existed and after the
+        newest config has been deleted; version numbers are never reused
+    '''
+    latest = session.query(Config.config_id, Config.hconfig, Config.version).\
+        filter(Config.device_id == device.device_id).\
+        order_by(Config.timestamp.desc()).first()
+
+    device.latest_config_id = latest.config_id if latest else None
+    device.latest_hconfig = latest.hconfig if latest else None
+    if not keep_version:
+        if latest is None:
+            device.latest_version = 0
+        else:
+            device.latest_version = latest.version or \
+                session.query(Config).filter(Config.device_id == device.device_id).count()
+
+def search_enabled():
+    '''
+        returns True when the database has the full text index over config bodies
+    '''
+    init_db()
+    return bool(sqlite_gen.search_index)
+
+def index_config(config, conf=None):
+    '''
+        adds the body of a config to the full text index
+
+        identical bodies (the same config on many devices, or a config changed
+        back) are indexed once, under the config_id of the first config holding
+        them; conf is only read when the body is not indexed yet
+    '''
+    if not search_enabled():
+        return
+    #rowids that grow with config_id keep the fts5 doclists small
+    body_id = session.query(Config.body_id).filter(Config.hconfig == config.hconfig,
+        Config.body_id != None).limit(1).scalar()
+    if body_id is None:
+        body_id = config.config_id
+        session.execute(text('INSERT INTO config_fts (rowid, body) VALUES (:body_id, :body)'),
+            {'body_id': body_id, 'body': config.config if conf is None else conf}, mapper=Config)
+    config.body_id = body_id
+    config.indexed = True
+
+def unindex_config(config):
+    '''
+        removes the body of a config from the full text index unless another
+        config shares it
+
+        the index is contentless so the exact body that was indexed has to be supplied
+    '''
+    if search_enabled() and config.indexed and config.body_id is not None:
+        shared = session.query(Config.config_id).filter(Config.hconfig == config.hconfig,
+            Config.body_id != None, Config.config_id != config.config_id).first()
+        if shared is None:
+            session.execute(text("INSERT INTO config_fts (config_fts, rowid, body) VALUES ('delete', :body_id, :body)"),
+                {'body_id': config.body_id, 'body': config.config}, mapper=Config)
+    config.body_id = None
+    config.indexed = False
+
+def reindex_configs(batch=200):
+    '''
+        rebuilds the full text index from every stored config, returns the number indexed
+    '''
+    if not search_enabled():
+        return 0
+    #recreated rather than emptied, so an index of whole words built by an older
+    #version becomes a trigram index where sqlite supports it
+    sqlite_gen.search_index = sqlite_gen.create_search_index(session.connection(mapper=Config), rebuild=True)
+    session.query(Config).update({Config.indexed: None, Config.body_id: None}, synchronize_session=False)
+    session.commit()
+
+    indexed = 0
+    last_id = 0
+    while True:
+        configs = session.query(Config).filter(Config.config_id > last_id).\
+            order_by(Config.config_id).limit(batch).all()
+        if not configs:
+            break
+        for config in configs:
+            index_config(config)
+            last_id = config.config_id
+            indexed += 1
+        session.commit()
+        session.expunge_all()
+    return indexed
+
+def search_phrase(pattern):
+    '''
+        returns the fts5 query that narrows a substring search for pattern down
+        to the bodies that can contain it, None when the index cannot narrow it
+        without dropping matches (every config is scanned then)
+
+        the index keeps no positions, so the query asks for bodies holding every
+        trigram (or word) of the pattern anywhere; search_configs() reads the
+        bodies to find the lines that really match
+    '''
+    if sqlite_gen.search_index == 'trigram':
+        #trigrams need at least three characters to look anything up
+        if len(pattern) < 3:
+            return None
+        tokens = []
+        for start in range(len(pattern) - 2):
+            token = '"{}"'.format(pattern[start:start + 3].replace('"', '""'))
+            if token not in tokens:
+                tokens.append(token)
+        return ' AND '.join(tokens)
+
+    #an index of whole words: a fragment starting inside a word ("hange" in
+    #"changed") has no token to look up, one ending inside a word is a prefix query
+    words = re.findall(r'[^\W_]+', pattern, re.U)
+    if not words or re.match(r'[^\W_]', pattern, re.U):
+        return None
+    tokens = ['"{}"'.format(word) for word in words]
+    if re.search(r'[^\W_]$', pattern, re.U):
+        tokens[-1] += ' *'
+    return ' AND '.join(tokens)
+
+def search_configs(pattern, latest_only=False, since=None, until=None):
+    '''
+        generator over (config, matching lines) for configs containing pattern,
+        matched case insensitively
+
+        the fts5 index narrows the search to configs whose body can contain the
+        pattern (see search_phrase()), only those bodies and the bodies of
+        configs not indexed yet are read to find the lines
+    '''
+    query = session.query(Config)
+    if latest_only:
+        #devices stored before they pointed at their newest config have no
+        #latest_config_id, their newest config is looked up as in latest_config_rows()
+        newest = aliased(Config)
+        fallback = session.query(newest.config_id).filter(newest.device_id == Config.device_id).\
+            order_by(newest.timestamp.desc()).limit(1).correlate(Config).as_scalar()
+        query = query.join(Device, Device.device_id == Config.device_id).\
+            filter(Config.config_id == func.coalesce(Device.latest_config_id, fallback))
+    if since is not None:
+        query = query.filter(Config.timestamp >= since)
+    if until is not None:
+        query = query.filter(Config.timestamp <= until)
+
+    phrase = search_phrase(pattern) if search_enabled() else None
+    if phrase is not None:
+        matches = text('SELECT rowid FROM config_fts WHERE config_fts MATCH :phrase').bindparams(phrase=phrase)
+        #configs stored before the index existed (indexed NULL) are read as well
+        query = query.filter(or_(Config.indexed == None, Config.indexed == False, Config.body_id.in_(matches)))
+
+    needle = pattern.lower()
+    for config in query.order_by(Config.device_id, Config.timestamp).yield_per(100):
+        lines = [line for line in config.config.split('\n') if needle in line.lower()]
+        if lines:
+            yield config, lines
 
 def insert_config(device, hconf, conf, ts):
     '''
         inserts a new config into the config table, update the config_changes counter,
         and update the last_seen timestamp
     '''
-    #uses the relationship between devices and configs to insert a new config for that object
-    device.configs.append(Config(hconfig=hconf, config=conf, timestamp=ts))
+    if device.latest_version is None:
+        refresh_latest(device)
+    previous = session.query(Config).get(device.latest_config_id) if device.latest_config_id else None
+
+    store_blob(hconf, conf)
+    config = Config(device_id=device.device_id, hconfig=hconf, timestamp=ts,
+        version=device.latest_version + 1)
+    if previous is not None:
+        #diffed once here so reviewing the change never has to diff again
+        config.diff = compress(unified(previous.config, conf, label(previous), label(config)), 'zlib')[1]
+        config.diff_base = previous.config_id
+    session.add(config)
+    session.flush()
+
+    index_config(config, conf)
+    device.latest_config_id = config.config_id
+    device.latest_hconfig = hconf
+    device.latest_version = config.version
     device.last_seen = ts
-    if len(device.configs) > 1:
+    device.last_change = ts
+    if config.version > 1:
         device.config_changes += 1
-    session.commit()
+
+    if HISTORY == 'delta' and previous is not None:
+        demote_config(previous, config, conf)
+    commit()
 
 def compare_config(device, hconfig):
     '''
         returns True or False if the hashed config matches the latest hashed config
         for the device
     '''
-    #checks the first config (object is presorted to descending based on timestamp)
-    if device.configs and device.configs[0].hconfig == hconfig:
-            return True
-    else:
-        return False
+    #the device keeps a pointer to its newest config, the config history is never loaded
+    if device.latest_version is None:
+        refresh_latest(device)
+    return device.latest_hconfig == hconfig
+
+def config_diff(older, newer, mode='unified'):
+    '''
+        returns the diff between two configs, using the diff stored when newer was
+        inserted if older is the config it was taken against
+    '''
+    if mode == 'unified' and newer.diff_base is not None and newer.diff_base == older.config_id:
+        return decompress('zlib', newer.diff)
+    return cached_diff(older, newer, mode)
+
+def change_diff(config):
+    '''
+        returns the diff recorded when the config was inserted, falling back to a
+        diff against the previous config for configs stored before diffs were kept
+    '''
+    if config.diff_base is not None:
+        return decompress('zlib', config.diff)
+    previous = previous_config(config)
+    return cached_diff(previous, config) if previous else None
+
+def previous_config(config):
+    '''
+        returns the config of the same device stored just before this one, or None
+    '''
+    return session.query(Config).filter(Config.device_id == config.device_id,
+        Config.timestamp < config.timestamp).order_by(Config.timestamp.desc()).first()
+
+def next_change(since):
+    '''
+        generator over (device, config) for every config stored since the given time
+    '''
+    query = session.query(Device, Config).join(Config, Config.device_id == Device.device_id).\
+        filter(Config.timestamp >= since).order_by(Device.device_id, Config.timestamp).\
+        options(undefer(Config.diff))
+    for device, config in query.yield_per(100):
+        yield device, config
 
 def delete_config(config):
     '''
         deletes a config from the database
     '''
+    #configs stored as a delta against this one are re-encoded against its own base,
+    #or stored in full when this one is full
+    base = session.query(Config).get(config.delta_base) if config.delta is not None else None
+    for dependent in session.query(Config).filter(Config.delta_base == config.config_id):
+        dependent_text = dependent.config
+        if base is not None:
+            dependent.delta = make_delta(base.config, dependent_text)
+            dependent.delta_base = base.config_id
+        else:
+            store_blob(dependent.hconfig, dependent_text)
+            dependent.delta = None
+            dependent.delta_base = None
+
+    device = config.device
+    unindex_config(config)
     session.delete(config)
-    session.commit()
+    session.flush()
+    drop_blob(config.hconfig)
+    if device is not None and device.latest_config_id == config.config_id:
+        refresh_latest(device, keep_version=True)
+    commit()
+
+def encode_history(device):
+    '''
+        numbers the configs of a device and, in delta mode, replaces every
+        non-keyframe config older than the latest with a reverse delta
+    '''
+    configs = session.query(Config).filter(Config.device_id == device.device_id).order_by(Config.timestamp).all()
+    for number, config in enumerate(configs, 1):
+        if config.version is None:
+            config.version = number
+
+    if HISTORY == 'delta' and configs:
+        newer_text = configs[-1].config
+        for older, newer in reversed(zip(configs[:-1], configs[1:])):
+            older_text = older.config
+            demote_config(older, newer, newer_text)
+            newer_text = older_text
+
+    if configs:
+        device.latest_config_id = configs[-1].config_id
+        device.latest_hconfig = configs[-1].hconfig
+        device.latest_version = max(device.latest_version, configs[-1].version)
+    commit()
+
+def get_setting(name, default=None):
+    '''
+        returns the value stored for a setting, default when it was never set
+    '''
+    value = session.query(Setting.value).filter(Setting.name == name).scalar()
+    return default if value is None else value
+
+def set_setting(name, value):
+    '''
+        stores the value of a setting
+    '''
+    session.merge(Setting(name=name, value=str(value)))
+    commit()
+
+def load_history_settings(history=None, keyframe=None):
+    '''
+        sets HISTORY and KEYFRAME_INTERVAL from the database, storing history
+        and keyframe first when given so they stay in effect for later runs
+    '''
+    global HISTORY, KEYFRAME_INTERVAL
+    if history is not None:
+        set_setting('history', history)
+    if keyframe is not None:
+        set_setting('keyframe', keyframe)
+    HISTORY = get_setting('history', 'full')
+    KEYFRAME_INTERVAL = int(get_setting('keyframe', 16))
+
+def pack_configs(batch=500):
+    '''
+        moves config bodies stored inline by older versions into config_blob and
+        re-encodes each device's history for the current HISTORY mode,
+        returns the number of configs moved
+    '''
+    moved = 0
+    while True:
+        configs = session.query(Config).filter(Config.inline != '').limit(batch).all()
+        if not configs:
+            break
+        for config in configs:
+            store_blob(config.hconfig, config.inline)
+            session.flush()
+            config.inline = ''
+            moved += 1
+        session.commit()
+        session.expunge_all()
+
+    for device in next_device():
+        encode_history(device)
+
+    #hand the freed pages back to the filesystem
+    engine = session.get_bind(Config)
+    if engine.dialect.name == 'sqlite':
+        engine.execute('VACUUM')
+    return moved
+
+def reschedule(device, next_poll):
+    '''
+        updates when the device is next due to be polled
+    '''
+    device.next_poll = next_poll
+    commit()
+
+def record_history(device, ts, outcome, timings, size=None, error=None):
+    '''
+        adds a row to poll_history, timings is a dictionary of phase -> seconds
+        using the phases connect, fetch, hash and persist
+    '''
+    session.add(PollHistory(device_id=device.device_id, timestamp=ts, outcome=outcome,
+        error=error, size=size, connect_time=timings.get('connect'), fetch_time=timings.get('fetch'),
+        hash_time=timings.get('hash'), persist_time=timings.get('persist')))
+    commit()
+
+def poll_history_rows(since):
+    '''
+        generator of poll_history rows recorded since a datetime, oldest first
+    '''
+    query = session.query(PollHistory.device_id, PollHistory.timestamp, PollHistory.outcome,
+        PollHistory.error, PollHistory.connect_time, PollHistory.fetch_time, PollHistory.hash_time,
+        PollHistory.persist_time, PollHistory.size).\
+        filter(PollHistory.timestamp >= since).order_by(PollHistory.timestamp)
+    for row in query.yield_per(1000):
+        yield row
+
+def prune_poll_history(before):
+    '''
+        deletes poll_history rows older than a datetime, returns the number deleted
+    '''
+    deleted = session.query(PollHistory).filter(PollHistory.timestamp < before).\
+        delete(synchronize_session=False)
+    commit()
+    return deleted
+
+def update_probe(device, marker, ts):
+    '''
+        remembers the change probe marker seen with a full config fetch
+    '''
+    device.probe_marker = marker
+    device.full_fetched = ts
+    commit()
+
+def update_fetch_time(device, seconds):
+    '''
+        stores the learned fetch time of a device, None forgets it
+    '''
+    device.fetch_time = seconds
+    commit()
+
+def update_latest_hash(device, hconfig):
+    '''
+        points the comparison of the next poll at the hash of the normalized
+        newest config, for a newest config stored with its volatile lines
+    '''
+    device.latest_hconfig = hconfig
+    commit()
 
 def update_timestamp(device, ts):
     '''
         updates the last_seen timestamp of a device
     '''
     device.last_seen = ts
-    session.commit()
+    commit()
 
 def update_device(device, field, value):
     '''
@@ -110,14 +776,18 @@ def update_device(device, field, value):
         device.missed_polls = value
     elif field == 'config_changes':
         device.config_changes = value
-    session.commit()
+    elif field == 'poll_interval':
+        device.poll_interval = value
+    elif field == 'priority':
+        device.priority = value
+    commit()
 
 def missed_poll(device):
     '''
         updates the missed_polls counter
     '''
     device.missed_polls += 1
-    session.commit()
+    commit()
 
 def clear_counters(device):
     '''
@@ -125,14 +795,14 @@ def clear_counters(device):
     '''
     device.missed_polls = 0
     device.config_changes = 0
-    session.commit()
+    commit()
 
 def delete_device(device):
     '''
         remove a device from the database
     '''
     session.delete(device)
-    session.commit()
+    commit()
 
-#connects to the database and renders a session object for manipulation
-session = get_session()
+#session object for manipulation, created on first use in each thread
+session = scoped_session(get_session)
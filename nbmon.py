@@ -8,31 +8,115 @@
             - Utilizes sqlalchemy to interact with the database
 
             Parameters
+                --db-url    - database to use, also read from NBMON_DB_URL (default sqlite:///nbmon.db)
                 -d  - launch nbmon as a daemon
                 -s  - display status (active and have either missed a poll or had a configuration change)
-                -f  - load database via json formatted file
+                      --only-missed, --changed-since, --limit and --format table|json|csv narrow and shape it
+                --changes   - show the diff of every config change since a date
+                --search    - find configs containing a line (--latest-only, --since, --until)
+                --reindex   - rebuild the search index
+                --as-of     - print the config --device (id or ip) was running at a point in time
+                --history   - list the config versions of --device (or count them for every device),
+                      narrowed with --since and --until
+                -f  - load database via json formatted file (re-loading updates devices by ip and port)
                 -c  - clear all counters
                 -e  - edit database
+                -w  - number of devices polled concurrently (daemon)
+                --max-sessions, --idle-timeout  - ssh sessions kept open between polls with --forever
+                      (default idle timeout just over --interval, devices need an exec timeout at least as long)
+                --pack      - compress configs stored by older versions (and delta encode with --storage delta)
+                --storage   - keep config history in full or as reverse deltas (remembered in the database)
+                --compact   - apply the retention policy (--keep-all-days, --keep-daily-days)
+                --no-probe  - always fetch the full config instead of checking the change marker first
+                --full-every    - seconds after which the full config is fetched regardless of the marker
+                --reach-timeout - seconds devices get to accept a tcp connect on their ssh port before
+                      being polled (--no-reach-check polls every device over ssh straight away)
+                --syslog, --webhook, --alert-file   - extra alert destinations (--coalesce merges repeats)
+                --export    - write the latest config of every device to a directory (optionally
+                      committed with --export-git) or tarball, rewriting only what changed
+                --metrics   - write poll timing metrics (prometheus text or json), also after each daemon pass
+                --lease     - share the devices with other workers (one pass, or resident with --forever; not with --compact)
+                --forever   - keep the daemon resident, polling each device on its own interval
 
     Copyright 2017 Ron Wellman
 '''
 
 import sys
+import os
+import socket
 import datetime
 import click
-import db.sqlite_query as db
-from db.sqlite_fill import load_database
-from utils.util import *
+
+def parse_timestamp(ctx, param, value):
+    '''
+        click callback turning "YYYY-MM-DD[ HH:MM[:SS]]" (UTC) into a datetime
+    '''
+    if value is None:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise click.BadParameter('use YYYY-MM-DD or "YYYY-MM-DD HH:MM[:SS]"')
 
 @click.command()
+@click.option('--db-url', help='sqlalchemy database url (default sqlite:///nbmon.db)', envvar='NBMON_DB_URL')
 @click.option('--daemon', '-d', help='launch nbmon as a daemon', is_flag=True)
 @click.option('--status', '-s', help='display status of active devices', is_flag=True)
+@click.option('--only-missed', help='status: only devices that have missed polls', is_flag=True)
+@click.option('--changed-since', help='status: only devices changed since "YYYY-MM-DD[ HH:MM[:SS]]" UTC', callback=parse_timestamp)
+@click.option('--limit', help='status: show at most this many devices', type=click.IntRange(1, None))
+@click.option('--format', 'output', help='status: output format', type=click.Choice(['table', 'json', 'csv']), default='table')
+@click.option('--changes', help='show every config change since "YYYY-MM-DD[ HH:MM[:SS]]" UTC', callback=parse_timestamp)
+@click.option('--search', help='find configs containing a line fragment, e.g. "snmp-server community public"')
+@click.option('--latest-only', help='search: only the latest config of each device', is_flag=True)
+@click.option('--since', help='search/history: only configs stored since "YYYY-MM-DD[ HH:MM[:SS]]" UTC', callback=parse_timestamp)
+@click.option('--until', help='search/history: only configs stored until "YYYY-MM-DD[ HH:MM[:SS]]" UTC', callback=parse_timestamp)
+@click.option('--device', 'device_ref', help='as-of/history: device id or ip')
+@click.option('--as-of', help='print the config --device was running at "YYYY-MM-DD[ HH:MM[:SS]]" UTC', callback=parse_timestamp)
+@click.option('--history', help='list the stored config versions of --device, or count them per device', is_flag=True)
+@click.option('--reindex', help='rebuild the search index from every stored config', is_flag=True)
 @click.option('--inputfile', '-f', help='load database via json formatted file',type=click.File('r'))
 @click.option('--clear', '-c', help='clear counters', is_flag=True)
 @click.option('--edit', '-e', help='edit the database', is_flag=True)
 @click.option('--logfile', '-l', help='use a custom log file',type=click.File('a'), default=sys.stdout)
 @click.option('--verbose', '-v', help='enable verbose logging', is_flag=True)
-def cli(daemon, status, inputfile, clear, edit, logfile, verbose):
+@click.option('--workers', '-w', help='number of devices polled concurrently', type=click.IntRange(1, None), default=8)
+@click.option('--max-sessions', help='maximum number of ssh sessions kept open', type=click.IntRange(1, None), default=100)
+@click.option('--idle-timeout', help='seconds before an idle ssh session is closed with --forever (default: just over --interval, the device exec timeout has to be at least as long)', type=click.IntRange(0, None))
+@click.option('--pack', help='move configs stored by older versions into the compressed blob store', is_flag=True)
+@click.option('--storage', help='how config history is stored, kept for later runs (default full)', type=click.Choice(['full', 'delta']))
+@click.option('--keyframe', help='in delta storage keep every Nth config in full, kept for later runs (default 16)', type=click.IntRange(1, None))
+@click.option('--batch-size', help='poll results committed per database transaction', type=click.IntRange(1, None), default=200)
+@click.option('--batch-window', help='maximum seconds poll results wait before being committed', type=click.IntRange(0, None), default=5)
+@click.option('--compact', help='apply the retention policy (in the background with --daemon --forever)', is_flag=True)
+@click.option('--keep-all-days', help='retention: keep every config for this many days', type=click.IntRange(0, None), default=30)
+@click.option('--keep-daily-days', help='retention: then keep one config per day up to this many days, one per month after', type=click.IntRange(0, None), default=365)
+@click.option('--lease', help='share the devices with other nbmon workers through the lease table', is_flag=True)
+@click.option('--worker-id', help='name of this worker in the lease table (default host:pid)')
+@click.option('--lease-ttl', help='seconds before a lease of a crashed worker expires', type=click.IntRange(60, None), default=900)
+@click.option('--probe/--no-probe', help='check a small change marker before fetching the full config', default=True)
+@click.option('--full-every', help='seconds after which the full config is fetched even if the change marker did not move', type=click.IntRange(0, None), default=86400)
+@click.option('--reach-check/--no-reach-check', help='tcp connect to the ssh port of devices in bulk before polling them', default=True)
+@click.option('--reach-timeout', help='seconds a device gets to accept the reachability check', type=float, default=2.0)
+@click.option('--syslog', help='also send alerts to a syslog server, HOST[:PORT] (udp)')
+@click.option('--webhook', help='also POST alerts as json to this url')
+@click.option('--alert-file', help='also append alerts to this file as json lines', type=click.Path(dir_okay=False))
+@click.option('--coalesce', help='seconds during which repeated alerts for a device are merged into one', type=click.IntRange(0, None), default=300)
+@click.option('--export', help='write the latest config of every device to a directory or a .tar[.gz] file')
+@click.option('--export-git', help='export: commit the export directory to a git repository in it', is_flag=True)
+@click.option('--metrics', help='write poll timing metrics to a file ("-" for stdout), refreshed by the daemon')
+@click.option('--metrics-format', help='metrics output format', type=click.Choice(['prometheus', 'json']), default='prometheus')
+@click.option('--metrics-window', help='seconds of poll history summarized in the metrics', type=click.IntRange(60, None), default=3600)
+@click.option('--forever', help='keep running and poll each device on its own interval', is_flag=True)
+@click.option('--interval', help='default seconds between polls of a device (with --forever)', type=click.IntRange(60, None), default=3600)
+@click.option('--jitter', help='fraction of the interval used to randomize due times', type=float, default=0.1)
+def cli(db_url, daemon, status, only_missed, changed_since, limit, output, changes, search, latest_only, since, until,
+        device_ref, as_of, history, reindex, inputfile, clear, edit, logfile, verbose, workers, max_sessions, idle_timeout,
+        pack, storage, keyframe, batch_size, batch_window, compact, keep_all_days, keep_daily_days,
+        lease, worker_id, lease_ttl, probe, full_every, reach_check, reach_timeout, syslog, webhook, alert_file, coalesce,
+        export, export_git, metrics, metrics_format, metrics_window, forever, interval, jitter):
     '''
         nbmon - Network Baseline Monitor
 
@@ -40,35 +124,135 @@ def cli(daemon, status, inputfile, clear, edit, logfile, verbose):
     '''
     exit_code = 0
 
+    #imported here so --help and usage errors never load sqlalchemy, the rest
+    #is imported by the option that needs it (netmiko only once a device is polled)
+    import db.sqlite_query as db
+    from utils.util import generate_log, record_poll, display_status, clear_counters, \
+        edit_device, search_report, changes_report, as_of_report, history_report
+
+    db.init_db(db_url)
+    db.load_history_settings(storage, keyframe)
+
     #daemonize
     if daemon:
+        if lease and compact:
+            #every worker would compact the same devices at once
+            raise click.UsageError('--compact cannot be combined with --lease, run it from one host on its own')
         if verbose:
             generate_log(logfile, 'NBMON started - DAEMON', 'INFO')
-        for device in db.next_active_device():
-
-                config = get_config(device, logfile)
-                if config == None:
-                    continue
-
-                timestamp = datetime.datetime.utcnow()
-                hconfig = generate_hash(config)
-
-                #Compare newly hashed config to the last one entered into the db
-                if not db.compare_config(device,hconfig):
-                    print 'CHANGE TO "%s": Inserting new config into DB' % device.description
-                    db.insert_config(device, hconfig, config, timestamp)
-                    generate_log(logfile, '{} configuration change'.format(device.ip), 'WARNING')
-                else:
-                    db.update_timestamp(device, timestamp)
+        from utils.poller import Poller, poll_devices
+        from utils.scheduler import Scheduler, run as run_scheduler, run_leased
+        from utils.sshpool import SessionPool
+        from utils.metrics import write_metrics
+        from db.sqlite_compact import Compactor, enable_incremental_vacuum
+        import utils.alerts as alerts
+        if forever and compact:
+            #the compactor only gives pages back once the file uses incremental vacuum,
+            #switched before any session work as VACUUM cannot run inside a transaction
+            enable_incremental_vacuum()
+        #alerts are delivered by background threads, polling never waits on a sink
+        sinks = [alerts.LogSink(logfile)]
+        if syslog:
+            host, sep, port = syslog.partition(':')
+            sinks.append(alerts.SyslogSink(host, int(port or 514)))
+        if webhook:
+            sinks.append(alerts.WebhookSink(webhook))
+        if alert_file:
+            sinks.append(alerts.FileSink(alert_file))
+        alerts.start_alerts(sinks, coalesce)
+        #ssh sessions run on the worker threads, all database work stays on this thread
+        #sessions are only reused by --forever, so by default they outlive the longest jittered
+        #interval; a single pass logs out of every device as soon as it has been polled
+        pool = None
+        if forever:
+            if idle_timeout is None:
+                idle_timeout = int(interval * (1 + min(1, max(0, jitter)))) + 60
+            pool = SessionPool(max_open=max_sessions, idle_timeout=idle_timeout)
+        db.begin_batch(batch_size, batch_window)
+        reach_timeout = reach_timeout if reach_check else None
+        try:
+            if lease:
+                poller = Poller(workers, pool, probe, full_every, reach_timeout)
+                owner = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+                exporter = (lambda: write_metrics(metrics, metrics_format, metrics_window)) if metrics else None
+                try:
+                    run_leased(Scheduler(interval=interval, jitter=min(1, max(0, jitter))), poller, logfile,
+                        owner, lease_ttl, forever, exporter)
+                except KeyboardInterrupt:
+                    pass
+                poller.close()
+            elif forever:
+                poller = Poller(workers, pool, probe, full_every, reach_timeout)
+                compactor = Compactor(keep_all_days, max(keep_all_days, keep_daily_days)) if compact else None
+                exporter = (lambda: write_metrics(metrics, metrics_format, metrics_window)) if metrics else None
+                try:
+                    run_scheduler(Scheduler(interval=interval, jitter=min(1, max(0, jitter))), poller, logfile,
+                        pool, compactor, exporter)
+                except KeyboardInterrupt:
+                    pass
+                poller.close()
+            else:
+                for device, config, error, timings, marker in poll_devices(db.next_active_device(), workers, pool,
+                        probe, full_every, reach_timeout):
+                    record_poll(device, config, error, logfile, timings, marker)
+                    db.poll_done()
+        finally:
+            db.end_batch()
+            alerts.stop_alerts()
+        if pool is not None:
+            pool.close()
+        if metrics:
+            write_metrics(metrics, metrics_format, metrics_window)
     #display status
     elif status:
         if verbose:
             generate_log(logfile, 'NBMON started - STATUS', 'INFO')
-        display_status()
+        display_status(only_missed, changed_since, limit, output)
+
+    #review config changes
+    elif changes:
+        if verbose:
+            generate_log(logfile, 'NBMON started - CHANGES', 'INFO')
+        changes_report(changes)
+
+    #search stored configs
+    elif search:
+        if verbose:
+            generate_log(logfile, 'NBMON started - SEARCH', 'INFO')
+        search_report(search, latest_only, since, until)
+
+    #config a device was running at a point in time
+    elif as_of:
+        if verbose:
+            generate_log(logfile, 'NBMON started - AS OF', 'INFO')
+        device = db.find_device(device_ref) if device_ref else None
+        if device is None:
+            raise click.UsageError('--as-of needs --device with the id or ip of a known device')
+        if not as_of_report(device, as_of):
+            generate_log(logfile, 'Device {} had no config stored at {:%Y-%m-%d %H:%M:%S} UTC'.format(device_ref, as_of),
+                'WARNING')
+
+    #versions stored per device
+    elif history:
+        if verbose:
+            generate_log(logfile, 'NBMON started - HISTORY', 'INFO')
+        device = db.find_device(device_ref) if device_ref else None
+        if device_ref and device is None:
+            raise click.UsageError('no device with id or ip {}'.format(device_ref))
+        history_report(device, since, until)
+
+    #rebuild the search index
+    elif reindex:
+        if verbose:
+            generate_log(logfile, 'NBMON started - REINDEX', 'INFO')
+        indexed = db.reindex_configs()
+        generate_log(logfile, '{} configs indexed'.format(indexed), 'INFO')
 
     #input devices using a json formated file
     elif inputfile:
-        load_database(inputfile)
+        from db.sqlite_fill import load_database
+        counts = load_database(inputfile)
+        generate_log(logfile, 'Devices loaded: {added} added, {changed} changed, {unchanged} unchanged'.format(**counts), 'INFO')
         display_status()
 
     #clear all the counters
@@ -77,6 +261,38 @@ def cli(daemon, status, inputfile, clear, edit, logfile, verbose):
             generate_log(logfile, 'NBMON started - CLEAR', 'INFO')
         clear_counters()
 
+    #compress configs stored inline by older versions
+    elif pack:
+        if verbose:
+            generate_log(logfile, 'NBMON started - PACK', 'INFO')
+        moved = db.pack_configs()
+        generate_log(logfile, '{} configs moved to the blob store, history stored as {}'.format(moved, db.HISTORY), 'INFO')
+
+    #apply the retention policy
+    elif compact:
+        if verbose:
+            generate_log(logfile, 'NBMON started - COMPACT', 'INFO')
+        from db.sqlite_compact import Compactor, enable_incremental_vacuum
+        enable_incremental_vacuum()
+        deleted = Compactor(keep_all_days, max(keep_all_days, keep_daily_days)).run()
+        generate_log(logfile, '{} configs removed by the retention policy'.format(deleted), 'INFO')
+
+    #write the latest configs out as files
+    elif export:
+        if verbose:
+            generate_log(logfile, 'NBMON started - EXPORT', 'INFO')
+        from utils.export import export_configs
+        counts = export_configs(export, export_git)
+        generate_log(logfile, 'Configs exported to {}: {written} written, {unchanged} unchanged, {removed} removed'.format(
+            export, **counts), 'INFO')
+
+    #export poll timing metrics
+    elif metrics:
+        if verbose:
+            generate_log(logfile, 'NBMON started - METRICS', 'INFO')
+        from utils.metrics import write_metrics
+        write_metrics(metrics, metrics_format, metrics_window)
+
     #edit the database
     elif edit:
         if verbose:
@@ -0,0 +1,145 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    test_retention.py -> retention buckets and deleting configs from a history
+
+    Run from the top of the repository:
+        python -m unittest discover tests
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import db.sqlite_query as db
+from db.sqlite_compact import expired_configs
+from db.sqlite_gen import Config, Device
+
+NOW = datetime.datetime(2017, 6, 30, 12, 0)
+KEEP_ALL = datetime.timedelta(days=30)
+KEEP_DAILY = datetime.timedelta(days=365)
+
+#init_db() binds once per process, every test adds its own device to one database
+workdir = None
+
+def setUpModule():
+    global workdir
+    workdir = tempfile.mkdtemp(prefix='nbmon-test-')
+    db.init_db('sqlite:///' + os.path.join(workdir, 'nbmon.db'))
+
+def tearDownModule():
+    db.session.remove()
+    shutil.rmtree(workdir)
+
+class ExpiredConfigsTest(unittest.TestCase):
+
+    def expired(self, *timestamps):
+        rows = [(config_id, timestamp) for config_id, timestamp in enumerate(timestamps, 1)]
+        return expired_configs(rows, NOW, KEEP_ALL, KEEP_DAILY)
+
+    def test_no_configs(self):
+        self.assertEqual(self.expired(), [])
+
+    def test_first_and_latest_always_kept(self):
+        self.assertEqual(self.expired(datetime.datetime(2015, 3, 1), datetime.datetime(2015, 3, 2)), [])
+
+    def test_keep_all(self):
+        #everything younger than keep_all stays, however many a day
+        self.assertEqual(self.expired(datetime.datetime(2015, 3, 1),
+                                      datetime.datetime(2017, 6, 10, 1),
+                                      datetime.datetime(2017, 6, 10, 2),
+                                      datetime.datetime(2017, 6, 10, 3),
+                                      datetime.datetime(2017, 6, 30)), [])
+
+    def test_daily(self):
+        #the last config of each day is kept between keep_all and keep_daily
+        self.assertEqual(self.expired(datetime.datetime(2015, 3, 1),
+                                      datetime.datetime(2017, 1, 10, 8),
+                                      datetime.datetime(2017, 1, 10, 18),
+                                      datetime.datetime(2017, 1, 11, 9),
+                                      datetime.datetime(2017, 1, 12, 9),
+                                      datetime.datetime(2017, 1, 12, 10),
+                                      datetime.datetime(2017, 6, 30)), [2, 5])
+
+    def test_monthly(self):
+        #the last config of each month is kept past keep_daily
+        self.assertEqual(self.expired(datetime.datetime(2015, 3, 1),
+                                      datetime.datetime(2015, 3, 5),
+                                      datetime.datetime(2015, 3, 20),
+                                      datetime.datetime(2015, 4, 2),
+                                      datetime.datetime(2015, 5, 1),
+                                      datetime.datetime(2015, 5, 31),
+                                      datetime.datetime(2017, 6, 30)), [2, 5])
+
+class DeleteConfigTest(unittest.TestCase):
+    '''
+        deletes configs from a delta history and rebuilds the versions left
+    '''
+
+    def setUp(self):
+        db.load_history_settings('delta', 4)
+        self.device = Device(device_type='cisco_ios', ip='10.0.0.1', port=22, username='test',
+            password='test', actively_poll=True, missed_polls=0, config_changes=0)
+        db.session.add(self.device)
+        db.commit()
+
+        #versions 4 and 8 are keyframes, 9 is the latest and also kept in full
+        self.texts = {}
+        for version in range(1, 10):
+            text = 'hostname r1\n' + ''.join('interface Gi0/{}\n description rev {}\n!\n'.format(port, version)
+                for port in range(version)) + 'end\n'
+            db.insert_config(self.device, hashlib.sha512(text).hexdigest(), text,
+                NOW - datetime.timedelta(days=10 - version))
+            self.texts[version] = text
+
+    def tearDown(self):
+        db.load_history_settings('full', 16)
+        db.session.remove()
+
+    def config(self, version):
+        return db.session.query(Config).filter(Config.device_id == self.device.device_id,
+            Config.version == version).one()
+
+    def assertRebuilds(self, versions):
+        db.session.expire_all()
+        configs = db.session.query(Config).filter(Config.device_id == self.device.device_id).\
+            order_by(Config.version).all()
+        self.assertEqual([config.version for config in configs], versions)
+        for config in configs:
+            self.assertEqual(config.config, self.texts[config.version])
+            self.assertEqual(db.config_body(config.config_id), self.texts[config.version])
+
+    def test_history_is_delta_encoded(self):
+        full = [config.version for config in db.session.query(Config).filter(
+            Config.device_id == self.device.device_id, Config.delta == None)]
+        self.assertEqual(sorted(full), [4, 8, 9])
+        self.assertRebuilds(range(1, 10))
+
+    def test_delete_keyframe(self):
+        #version 3 was a delta against the keyframe and has to be stored in full
+        db.delete_config(self.config(4))
+        self.assertIsNone(self.config(3).delta)
+        self.assertRebuilds([1, 2, 3, 5, 6, 7, 8, 9])
+
+    def test_delete_delta(self):
+        #version 5 was a delta against 6 and is re-encoded against 7
+        db.delete_config(self.config(6))
+        self.assertEqual(self.config(5).delta_base, self.config(7).config_id)
+        self.assertRebuilds([1, 2, 3, 4, 5, 7, 8, 9])
+
+    def test_delete_keyframe_and_delta(self):
+        db.delete_config(self.config(4))
+        db.delete_config(self.config(2))
+        db.delete_config(self.config(9))
+        self.assertRebuilds([1, 3, 5, 6, 7, 8])
+        self.assertEqual(self.device.latest_config_id, self.config(8).config_id)
+        found = db.search_configs('description rev 1')
+        self.assertEqual([config.version for config, lines in found if config.device_id == self.device.device_id], [1])
+
+if __name__ == '__main__':
+    unittest.main()
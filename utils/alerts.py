@@ -0,0 +1,260 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    alerts.py -> non-blocking delivery of change and missed poll alerts
+
+    The poller only puts events on an in-process queue.  A dispatcher thread
+    coalesces them and hands them to one thread per sink, which delivers them
+    in batches and retries failed deliveries with backoff, so a slow syslog
+    server or webhook never holds up polling.
+
+    Coalescing: the first event of a kind (change or missed) for a device is
+    delivered right away, further events of that kind for the device within
+    the coalesce window are counted and delivered as one summary event when
+    the window closes.
+
+    Sinks
+        LogSink     - the nbmon log (and a console line per change)
+        SyslogSink  - RFC 3164 datagrams over UDP
+        WebhookSink - json POST of each batch: {"events": [...]}
+        FileSink    - one json object per line
+
+    Events are dictionaries with kind, device_id, ip, description, message,
+    timestamp (first event), last (last coalesced event), and count.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import json
+import socket
+import sys
+import threading
+import time
+import urllib2
+import Queue
+
+class LogSink(object):
+    '''
+        writes alerts to the nbmon log the way polls always have
+    '''
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+
+    def send(self, events):
+        from utils.util import generate_log
+        for event in events:
+            if event['kind'] == 'change' and event['count'] == 1:
+                print 'CHANGE TO "%s": Inserting new config into DB' % event['description']
+            generate_log(self.logfile, event['message'], 'WARNING')
+        self.logfile.flush()
+
+class SyslogSink(object):
+    '''
+        sends alerts as syslog datagrams (facility local0, severity warning)
+    '''
+
+    def __init__(self, host, port=514, facility=16):
+        self.address = (host, port)
+        self.priority = facility * 8 + 4
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, events):
+        for event in events:
+            message = u'<{}>nbmon: {} {}'.format(self.priority, event['kind'], event['message'])
+            self.sock.sendto(message.encode('utf-8'), self.address)
+
+class WebhookSink(object):
+    '''
+        posts each batch of alerts as json to a url
+    '''
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, events):
+        request = urllib2.Request(self.url, json.dumps({'events': events}),
+            {'Content-Type': 'application/json'})
+        urllib2.urlopen(request, timeout=self.timeout).close()
+
+class FileSink(object):
+    '''
+        appends alerts to a file, one json object per line
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, events):
+        with open(self.path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+class SinkWorker(object):
+    '''
+        delivers the events of one sink on its own thread in batches of up to
+        batch_size, waiting at most window seconds to fill a batch
+    '''
+
+    def __init__(self, sink, batch_size=50, window=2.0, retries=3, backoff=1.0, maxsize=10000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._work, name='nbmon-alerts-{}'.format(type(sink).__name__))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _work(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            batch = [event]
+            deadline = time.time() + self.window
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    event = self.queue.get(timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                batch.append(event)
+            self._deliver(batch)
+            if stop:
+                return
+
+    def _deliver(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.sink.send(batch)
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(min(30, self.backoff * 2 ** attempt))
+        self.dropped += len(batch)
+        sys.stderr.write('nbmon: {} alerts dropped by {}: {}\n'.format(len(batch), type(self.sink).__name__, error))
+
+    def stop(self, timeout=None):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+class AlertQueue(object):
+    '''
+        coalesces published events and fans them out to the sink workers
+    '''
+
+    def __init__(self, sinks, coalesce=300, batch_size=50, window=2.0, retries=3):
+        self.workers = [SinkWorker(sink, batch_size, window, retries) for sink in sinks]
+        self.coalesce = coalesce
+        self.inbound = Queue.Queue()
+        #(kind, device_id) -> [window closes at, suppressed count, first and last suppressed event]
+        self.open = {}
+        self.swept = 0
+        self.thread = threading.Thread(target=self._dispatch, name='nbmon-alerts')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, event):
+        self.inbound.put(event)
+
+    def _fan_out(self, event):
+        for worker in self.workers:
+            worker.put(event)
+
+    def _close_windows(self, now, everything=False):
+        self.swept = now
+        for key, (closes, count, first, last) in self.open.items():
+            if everything or closes <= now:
+                del self.open[key]
+                if count:
+                    summary = dict(last, timestamp=first['timestamp'], count=count)
+                    summary['message'] = u'{} ({} more within {}s)'.format(last['message'], count, self.coalesce)
+                    self._fan_out(summary)
+
+    def _dispatch(self):
+        while True:
+            try:
+                event = self.inbound.get(timeout=1)
+            except Queue.Empty:
+                event = False
+            now = time.time()
+
+            if event is None:
+                self._close_windows(now, everything=True)
+                return
+            if event:
+                key = (event['kind'], event['device_id'])
+                window = self.open.get(key)
+                if window is not None and window[0] > now:
+                    window[1] += 1
+                    window[2] = window[2] or event
+                    window[3] = event
+                else:
+                    if window is not None:
+                        self._close_windows(now)
+                    self.open[key] = [now + self.coalesce, 0, None, event]
+                    self._fan_out(event)
+            #expired windows are looked for about once a second, not on every event
+            if now - self.swept >= 1:
+                self._close_windows(now)
+
+    def stop(self, timeout=10):
+        '''
+            delivers whatever is still queued, waiting at most about timeout seconds
+        '''
+        self.inbound.put(None)
+        self.thread.join(timeout)
+        for worker in self.workers:
+            worker.stop(timeout)
+
+#running AlertQueue, None delivers alerts synchronously to the log (see record_poll)
+queue = None
+
+def start_alerts(sinks, coalesce=300, batch_size=50, window=2.0, retries=3):
+    '''
+        starts delivering published alerts to sinks in the background
+    '''
+    global queue
+    queue = AlertQueue(sinks, coalesce, batch_size, window, retries)
+    return queue
+
+def stop_alerts(timeout=10):
+    '''
+        flushes and stops the background delivery
+    '''
+    global queue
+    if queue is not None:
+        queue.stop(timeout)
+    queue = None
+
+def make_event(kind, device, message, ts=None):
+    '''
+        returns an alert event for a device
+    '''
+    ts = (ts or datetime.datetime.utcnow()).isoformat()
+    return {'kind': kind, 'device_id': device.device_id, 'ip': device.ip, 'description': device.description,
+            'message': message, 'timestamp': ts, 'last': ts, 'count': 1}
+
+def publish(event):
+    '''
+        queues an event for delivery, returns False when no AlertQueue is running
+    '''
+    if queue is None:
+        return False
+    queue.publish(event)
+    return True
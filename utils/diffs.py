@@ -0,0 +1,122 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    diffs.py -> differences between two configs
+
+    unified     - plain line diff
+    sections    - hierarchy aware diff for IOS style configs, where indented
+                  lines belong to the closest less indented line above them;
+                  changes are shown under the section they belong to and
+                  sections that only moved are not reported
+
+    Ad-hoc diffs are kept in a small LRU cache keyed by config ids.
+
+    Copyright 2017 Ron Wellman
+'''
+
+from collections import OrderedDict
+from difflib import unified_diff as udiff
+
+class LRUCache(object):
+    '''
+        dictionary that forgets the least recently used entry beyond maxsize
+    '''
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+cache = LRUCache()
+
+def label(config):
+    '''
+        header used for a config in a diff
+    '''
+    return '{:%Y-%m-%d %H:%M:%S} UTC'.format(config.timestamp)
+
+def unified(old_text, new_text, fromfile='', tofile=''):
+    '''
+        returns the unified diff of two config bodies as text
+    '''
+    return '\n'.join(udiff(old_text.split('\n'), new_text.split('\n'),
+        fromfile=fromfile, tofile=tofile, lineterm=''))
+
+def parse_sections(text):
+    '''
+        returns the config as a tree of OrderedDicts keyed by line, children
+        being the lines indented beneath it
+    '''
+    root = OrderedDict()
+    #(indent, children) from the top level down to the current section
+    stack = [(-1, root)]
+
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if not stripped or stripped == '!':
+            continue
+        indent = len(line) - len(line.lstrip())
+        while stack[-1][0] >= indent:
+            stack.pop()
+        children = stack[-1][1].setdefault(stripped, OrderedDict())
+        stack.append((indent, children))
+
+    return root
+
+def _subtree(tree, sign, depth):
+    lines = []
+    for line, children in tree.items():
+        lines.append('{}{}{}'.format(sign, ' ' * depth, line))
+        lines.extend(_subtree(children, sign, depth + 1))
+    return lines
+
+def _section_diff(old, new, depth):
+    lines = []
+    for line, children in old.items():
+        if line not in new:
+            lines.extend(_subtree(OrderedDict([(line, children)]), '-', depth))
+        else:
+            changed = _section_diff(children, new[line], depth + 1)
+            if changed:
+                lines.append(' {}{}'.format(' ' * depth, line))
+                lines.extend(changed)
+    for line, children in new.items():
+        if line not in old:
+            lines.extend(_subtree(OrderedDict([(line, children)]), '+', depth))
+    return lines
+
+def sections(old_text, new_text, fromfile='', tofile=''):
+    '''
+        returns a hierarchy aware diff of two IOS style config bodies as text
+    '''
+    lines = ['--- {}'.format(fromfile), '+++ {}'.format(tofile)]
+    lines.extend(_section_diff(parse_sections(old_text), parse_sections(new_text), 0))
+    return '\n'.join(lines)
+
+MODES = {'unified': unified, 'sections': sections}
+
+def cached_diff(old, new, mode='unified'):
+    '''
+        returns the diff between two Config objects, computing it at most once
+        while it stays in the cache
+    '''
+    key = (old.config_id, new.config_id, mode)
+    diff = cache.get(key)
+    if diff is None:
+        diff = MODES[mode](old.config, new.config, label(old), label(new))
+        cache.put(key, diff)
+    return diff
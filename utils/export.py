@@ -0,0 +1,181 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    export.py -> latest config of every device written out as files
+
+    Configs are streamed from the database one at a time, each device ending
+    up in <ip>.cfg (<ip>_<port>.cfg for a non-standard port).  A manifest
+    remembers the file and hconfig written for every device, so a later
+    export only rewrites devices whose latest config changed and removes the
+    files of deleted devices; an unchanged fleet exports without reading a
+    single config body.
+
+    Targets
+        directory   - updated in place, optionally committed to a git repository in it
+        tarball     - a path ending in .tar, .tar.gz, .tgz or .tar.bz2; rewritten as a
+                      whole (tar files cannot be changed in place), but only when the
+                      manifest next to it shows a change
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import json
+import os
+import subprocess
+import tarfile
+import time
+from StringIO import StringIO
+import db.sqlite_query as db
+
+#kept in the export directory, and next to a tarball as <tarball>.manifest.json
+MANIFEST = '.nbmon-export.json'
+
+TARBALLS = {'.tar': 'w', '.tar.gz': 'w:gz', '.tgz': 'w:gz', '.tar.bz2': 'w:bz2'}
+
+def tar_mode(path):
+    '''
+        returns the tarfile write mode for a tarball path, None for a directory
+    '''
+    for suffix, mode in TARBALLS.items():
+        if path.endswith(suffix):
+            return mode
+    return None
+
+def export_name(ip, port):
+    '''
+        returns the file name the config of a device is exported under
+    '''
+    name = ip.replace(':', '-')
+    if port and port != 22:
+        name = '{}_{}'.format(name, port)
+    return name + '.cfg'
+
+def load_manifest(path):
+    '''
+        returns the manifest of the previous export, device_id -> [file, hconfig]
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_atomic(path, body):
+    '''
+        writes a file next to its target and renames it over it
+    '''
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(body)
+    os.rename(tmp, path)
+
+def plan_export(previous, exists):
+    '''
+        compares the devices in the database against the previous manifest
+
+        returns (manifest, changed, removed): the new manifest, the
+        (device_id, name, config_id) of devices to write and the names of files
+        no device is exported under any more; exists(name) tells whether a file
+        from the previous export is still in place
+    '''
+    manifest = {}
+    changed = []
+    for device_id, ip, port, config_id, hconfig in db.latest_config_rows():
+        key = str(device_id)
+        name = export_name(ip, port)
+        manifest[key] = [name, hconfig]
+        if previous.get(key) != [name, hconfig] or not exists(name):
+            changed.append((device_id, name, config_id))
+
+    kept = set(name for name, hconfig in manifest.values())
+    removed = sorted(set(name for name, hconfig in previous.values()) - kept)
+    return manifest, changed, removed
+
+def export_directory(path, git=False):
+    '''
+        brings the export directory up to date, returns the counts of files
+        written, unchanged and removed
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    manifest_path = os.path.join(path, MANIFEST)
+    previous = load_manifest(manifest_path)
+    manifest, changed, removed = plan_export(previous, lambda name: os.path.exists(os.path.join(path, name)))
+
+    for device_id, name, config_id in changed:
+        write_atomic(os.path.join(path, name), db.config_body(config_id).encode('utf-8'))
+    for name in removed:
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+    if changed or removed or manifest != previous:
+        write_atomic(manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+
+    counts = {'written': len(changed), 'unchanged': len(manifest) - len(changed), 'removed': len(removed)}
+    if git and (changed or removed or not os.path.isdir(os.path.join(path, '.git'))):
+        commit_export(path, counts)
+    return counts
+
+def export_tarball(path, mode):
+    '''
+        rewrites the tarball when any device changed since it was written,
+        returns the counts of files written, unchanged and removed
+    '''
+    manifest_path = path + '.manifest.json'
+    previous = load_manifest(manifest_path) if os.path.exists(path) else {}
+    manifest, changed, removed = plan_export(previous, lambda name: True)
+    counts = {'written': len(changed), 'unchanged': len(manifest) - len(changed), 'removed': len(removed)}
+    if not changed and not removed and os.path.exists(path):
+        return counts
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    now = time.time()
+    tar = tarfile.open(tmp, mode)
+    try:
+        #a second pass, still one config body in memory at a time
+        for device_id, ip, port, config_id, hconfig in db.latest_config_rows():
+            body = db.config_body(config_id).encode('utf-8')
+            info = tarfile.TarInfo(export_name(ip, port))
+            info.size = len(body)
+            info.mtime = now
+            tar.addfile(info, StringIO(body))
+    finally:
+        tar.close()
+    os.rename(tmp, path)
+    write_atomic(manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+    return counts
+
+def run_git(path, *args):
+    '''
+        runs a git command in the export directory
+    '''
+    return subprocess.check_call(('git',) + args, cwd=path)
+
+def commit_export(path, counts):
+    '''
+        commits the export directory to its git repository, creating it first if needed
+    '''
+    if not os.path.isdir(os.path.join(path, '.git')):
+        run_git(path, 'init', '-q')
+    identity = ()
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call(['git', 'config', 'user.email'], cwd=path, stdout=devnull):
+            identity = ('-c', 'user.name=nbmon', '-c', 'user.email=nbmon@localhost')
+    run_git(path, 'add', '-A', '.')
+    with open(os.devnull, 'w') as devnull:
+        if not subprocess.call(['git', 'diff', '--cached', '--quiet'], cwd=path, stdout=devnull):
+            return
+    run_git(path, *(identity + ('commit', '-q', '-m', 'nbmon export {:%Y-%m-%d %H:%M:%S} UTC: {written} written, '
+        '{removed} removed'.format(datetime.datetime.utcnow(), **counts))))
+
+def export_configs(path, git=False):
+    '''
+        exports the latest config of every device to a directory or tarball,
+        returns the counts of files written, unchanged and removed
+    '''
+    mode = tar_mode(path)
+    if mode is not None:
+        return export_tarball(path, mode)
+    return export_directory(path, git)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    metrics.py -> poll timing metrics from poll_history
+
+    Every poll records how long it took to connect, fetch, hash, and persist
+    the config.  The rows of a recent window are summarized into latency
+    histograms per phase, poll counts per outcome, fleet throughput, and the
+    slowest devices, written either in the Prometheus text exposition format
+    (for the node_exporter textfile collector) or as json.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import json
+import os
+import sys
+import db.sqlite_query as db
+
+PHASES = ('connect', 'fetch', 'hash', 'persist', 'total')
+
+#histogram bucket upper bounds in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def percentile(values, fraction):
+    '''
+        returns the value below which fraction of the sorted values fall
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Histogram(object):
+    '''
+        cumulative bucket counts plus the raw values for percentiles
+    '''
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+def collect(window=3600, slowest=10, now=None):
+    '''
+        summarizes the polls of the last window seconds into a dictionary
+    '''
+    now = now or datetime.datetime.utcnow()
+    since = now - datetime.timedelta(seconds=window)
+    histograms = dict((phase, Histogram()) for phase in PHASES)
+    outcomes = {}
+    errors = {}
+    size = 0
+    devices = {}
+
+    for row in db.poll_history_rows(since):
+        outcomes[row.outcome] = outcomes.get(row.outcome, 0) + 1
+        if row.error:
+            errors[row.error] = errors.get(row.error, 0) + 1
+        size += row.size or 0
+
+        timings = (row.connect_time, row.fetch_time, row.hash_time, row.persist_time)
+        for phase, value in zip(PHASES, timings):
+            if value is not None:
+                histograms[phase].add(value)
+        total = sum(value or 0 for value in timings)
+        histograms['total'].add(total)
+        devices[row.device_id] = max(devices.get(row.device_id, 0), total)
+
+    polls = sum(outcomes.values())
+    phases = {}
+    for phase, histogram in histograms.items():
+        values = sorted(histogram.values)
+        phases[phase] = {'buckets': histogram.counts, 'count': len(values), 'sum': sum(values),
+            'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'p99': percentile(values, 0.99)}
+
+    slow = []
+    for device_id, total in sorted(devices.items(), key=lambda item: -item[1])[:slowest]:
+        device = db.get_device(device_id)
+        slow.append({'device_id': device_id, 'seconds': total,
+            'ip': device.ip if device else None, 'description': device.description if device else None})
+
+    return {'window': window, 'timestamp': now.isoformat(), 'polls': polls,
+            'devices': len(devices), 'polls_per_second': float(polls) / window,
+            'bytes': size, 'outcomes': outcomes, 'errors': errors,
+            'phases': phases, 'slowest': slow}
+
+def _label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus(metrics):
+    '''
+        returns the metrics in the Prometheus text exposition format
+    '''
+    lines = ['# HELP nbmon_poll_phase_seconds time spent per poll phase over the window',
+             '# TYPE nbmon_poll_phase_seconds histogram']
+    for phase in PHASES:
+        stats = metrics['phases'][phase]
+        for bound, count in zip(BUCKETS, stats['buckets']):
+            lines.append('nbmon_poll_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, bound, count))
+        lines.append('nbmon_poll_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(phase, stats['count']))
+        lines.append('nbmon_poll_phase_seconds_sum{{phase="{}"}} {}'.format(phase, stats['sum']))
+        lines.append('nbmon_poll_phase_seconds_count{{phase="{}"}} {}'.format(phase, stats['count']))
+
+    lines.append('# HELP nbmon_polls polls finished over the window by outcome')
+    lines.append('# TYPE nbmon_polls gauge')
+    for outcome, count in sorted(metrics['outcomes'].items()):
+        lines.append(u'nbmon_polls{{outcome="{}"}} {}'.format(_label(outcome), count))
+
+    lines.append('# HELP nbmon_poll_errors failed polls over the window by exception')
+    lines.append('# TYPE nbmon_poll_errors gauge')
+    for error, count in sorted(metrics['errors'].items()):
+        lines.append(u'nbmon_poll_errors{{error="{}"}} {}'.format(_label(error), count))
+
+    lines.append('# HELP nbmon_polls_per_second fleet throughput over the window')
+    lines.append('# TYPE nbmon_polls_per_second gauge')
+    lines.append('nbmon_polls_per_second {}'.format(metrics['polls_per_second']))
+    lines.append('# HELP nbmon_devices_polled distinct devices polled over the window')
+    lines.append('# TYPE nbmon_devices_polled gauge')
+    lines.append('nbmon_devices_polled {}'.format(metrics['devices']))
+    lines.append('# HELP nbmon_config_bytes config bytes received over the window')
+    lines.append('# TYPE nbmon_config_bytes gauge')
+    lines.append('nbmon_config_bytes {}'.format(metrics['bytes']))
+
+    lines.append('# HELP nbmon_slowest_poll_seconds slowest poll of the slowest devices over the window')
+    lines.append('# TYPE nbmon_slowest_poll_seconds gauge')
+    for device in metrics['slowest']:
+        lines.append(u'nbmon_slowest_poll_seconds{{device_id="{}",ip="{}",description="{}"}} {}'.format(
+            device['device_id'], _label(device['ip'] or ''), _label(device['description'] or ''), device['seconds']))
+
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(path, output='prometheus', window=3600):
+    '''
+        collects the metrics and writes them to path ('-' for stdout)
+
+        files are written next to the target and renamed over it so a scraper
+        never reads a half written file
+    '''
+    metrics = collect(window)
+    if output == 'json':
+        body = json.dumps(metrics, indent=2, sort_keys=True) + '\n'
+    else:
+        body = prometheus(metrics)
+    body = body.encode('utf-8')
+
+    if path == '-':
+        sys.stdout.write(body)
+        return metrics
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(body)
+    os.rename(tmp, path)
+    return metrics
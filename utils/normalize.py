@@ -0,0 +1,121 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    normalize.py -> strips volatile content from configs before hashing
+
+    Devices print timestamps, byte counts, clock drift, and certificate
+    bodies that change without anyone touching the config.  Each device_type
+    has a set of line patterns that are dropped and blocks whose bodies are
+    dropped (keeping the opening and closing lines).  Patterns are compiled
+    once at import.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import re
+
+IOS = {
+    'lines': [r'Building configuration\.\.\.',
+              r'Current configuration\s*:\s*\d+ bytes',
+              r'! Last configuration change at .*',
+              r'! NVRAM config last updated at .*',
+              r'! No configuration change since last restart',
+              r'ntp clock-period \d+'],
+    #self-signed and CA certificate bodies are regenerated or reformatted
+    'blocks': [(r' certificate (self-signed |ca )?\S+.*', r'\s+quit')],
+}
+
+NXOS = {
+    'lines': [r'!Command: show running-config.*',
+              r'!Time: .*',
+              r'!Running configuration last done at: .*'],
+    'blocks': [],
+}
+
+XR = {
+    'lines': [r'Building configuration\.\.\.',
+              r'!! IOS XR Configuration .*',
+              r'!! Last configuration change at .*',
+              r'(Mon|Tue|Wed|Thu|Fri|Sat|Sun) (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) .*'],
+    'blocks': [],
+}
+
+ASA = {
+    'lines': [r': Saved',
+              r': Written by .* at .*',
+              r'Cryptochecksum:\s*[0-9a-f]+',
+              r': end'],
+    'blocks': [(r' certificate (ca )?\S+.*', r'\s+quit')],
+}
+
+EOS = {
+    'lines': [r'! Command: show running-config.*',
+              r'! device: .*',
+              r'! Time: .*',
+              r'! Startup-config last modified at .*'],
+    'blocks': [],
+}
+
+JUNOS = {
+    'lines': [r'## Last commit: .*',
+              r'## Last changed: .*',
+              r'## Image name: .*'],
+    'blocks': [],
+}
+
+RAW_RULES = {
+    'cisco_ios': IOS,
+    'cisco_xe': IOS,
+    'cisco_nxos': NXOS,
+    'cisco_xr': XR,
+    'cisco_asa': ASA,
+    'arista_eos': EOS,
+    'juniper': JUNOS,
+    'juniper_junos': JUNOS,
+}
+
+class Rules(object):
+    '''
+        compiled normalization rules for a device type
+    '''
+
+    def __init__(self, lines, blocks):
+        #one alternation is much faster than trying every pattern per line
+        self.drop = re.compile('^(?:{})$'.format('|'.join(lines))) if lines else None
+        self.blocks = [(re.compile('^' + start + '$'), re.compile('^' + end + '$')) for start, end in blocks]
+
+RULES = dict((device_type, Rules(**rules)) for device_type, rules in RAW_RULES.items())
+
+def normalize_config(device_type, config):
+    '''
+        returns the config with line endings, trailing whitespace, and the
+        volatile content for the device type removed
+    '''
+    rules = RULES.get(device_type)
+    lines = []
+    end = None
+
+    for line in config.replace('\r\n', '\n').split('\n'):
+        line = line.rstrip()
+
+        if rules is None:
+            lines.append(line)
+            continue
+
+        if end is not None:
+            #inside a dropped block, keep only its closing line
+            if end.match(line):
+                lines.append(line)
+                end = None
+            continue
+
+        if rules.drop is not None and rules.drop.match(line):
+            continue
+
+        lines.append(line)
+        for start, block_end in rules.blocks:
+            if start.match(line):
+                end = block_end
+                break
+
+    return '\n'.join(lines)
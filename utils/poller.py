@@ -0,0 +1,197 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    poller.py -> concurrent config retrieval
+
+    SSH sessions are run on a bounded pool of worker threads, optionally
+    borrowing persistent sessions from a utils.sshpool.SessionPool.  Workers only
+    ever see plain connection parameters and fetch plans; every database object stays on the
+    thread that created the Poller so the shared session in sqlite_query is
+    only touched by a single writer.  Devices in flight are tracked by id, not
+    by orm object, and looked up again when their result is collected, so
+    device iteration is free to expunge them from the session meanwhile.
+
+    Submitted devices first pass a reachability thread that tcp connects to
+    the ssh port of everything queued at once (utils.reachability); devices
+    that do not answer come straight back as failed polls, only reachable
+    ones (and devices with an idle pooled session) reach the ssh workers.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import threading
+import Queue
+import datetime
+import itertools
+import time
+import db.sqlite_query as db
+from utils.util import connection_params, poll_device
+from utils.probes import probe_for
+from utils.profiles import fetch_plan
+from utils.reachability import check_ports
+
+class Poller(object):
+    '''
+        bounded pool of worker threads that fetch configs from devices
+    '''
+
+    def __init__(self, workers=1, pool=None, probe=True, full_every=86400, reach_timeout=2.0, reach_batch=256):
+        self.workers = max(1, workers)
+        self.pool = pool
+        #run the change probe of utils.probes, fetching in full at least every full_every seconds
+        self.probe = probe
+        self.full_every = full_every
+        #seconds devices get to accept a tcp connect before polling, None skips the check
+        self.reach_timeout = reach_timeout
+        self.reach_batch = reach_batch
+        #devices callers keep submitted at a time, enough to fill a reachability batch
+        self.window = self.workers * 2 + (reach_batch if reach_timeout else 0)
+        self.screen = Queue.Queue()
+        self.jobs = Queue.Queue()
+        self.done = Queue.Queue()
+        #token -> device_id of submitted devices
+        self.inflight = {}
+        self.tokens = itertools.count()
+        self.threads = []
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='nbmon-poller-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+        self.screener = None
+        if reach_timeout:
+            self.screener = threading.Thread(target=self._screen, name='nbmon-reach')
+            self.screener.daemon = True
+            self.screener.start()
+
+    def _screen(self):
+        '''
+            reachability loop: check everything queued so far in one batch, pass
+            reachable devices on to the workers and fail the rest right away
+        '''
+        while True:
+            job = self.screen.get()
+            if job is None:
+                return
+            batch = [job]
+            stop = False
+            while len(batch) < self.reach_batch:
+                try:
+                    job = self.screen.get_nowait()
+                except Queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+
+            started = time.time()
+            failed = check_ports([(token, params['ip'], params['port'] or 22)
+                for token, params, probe, plan in batch], self.reach_timeout)
+            elapsed = time.time() - started
+            for job in batch:
+                token = job[0]
+                if token in failed:
+                    self.done.put((token, None, failed[token], {'connect': elapsed}, None))
+                else:
+                    self.jobs.put(job)
+            if stop:
+                return
+
+    def _work(self):
+        '''
+            worker loop: pull connection parameters, fetch the config, hand back the result
+        '''
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            token, params, probe, plan = job
+            timings = {}
+            try:
+                config, marker = poll_device(params, probe, self.pool, timings, plan)
+                self.done.put((token, config, None, timings, marker))
+            except Exception as e:
+                self.done.put((token, None, e, timings, None))
+
+    def submit(self, device):
+        '''
+            queues a device for polling (must be called from the writer thread)
+        '''
+        token = next(self.tokens)
+        probe = probe_for(device, datetime.datetime.utcnow(), self.full_every) if self.probe else None
+        self.inflight[token] = device.device_id
+        params = connection_params(device)
+        job = (token, params, probe, fetch_plan(device.device_type, device.fetch_time))
+        #an idle pooled session is proof enough that the device is up
+        if self.screener is None or (self.pool is not None and self.pool.holds(params)):
+            self.jobs.put(job)
+        else:
+            self.screen.put(job)
+
+    def pending(self):
+        '''
+            number of devices submitted but not yet returned
+        '''
+        return len(self.inflight)
+
+    def result(self, timeout=None):
+        '''
+            returns the next finished (device, config, error, timings, marker) tuple
+            or None on timeout
+
+            timings holds the connect and fetch seconds of the poll, config is None
+            when the change probe found marker unchanged; the result of a device
+            deleted while it was being polled is dropped and None returned
+        '''
+        try:
+            token, config, error, timings, marker = self.done.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        device = db.get_device(self.inflight.pop(token))
+        if device is None:
+            return None
+        return device, config, error, timings, marker
+
+    def close(self):
+        '''
+            stops the worker threads
+        '''
+        if self.screener is not None:
+            self.screen.put(None)
+            self.screener.join()
+            self.screener = None
+        for t in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+def poll_devices(devices, workers=1, pool=None, probe=True, full_every=86400, reach_timeout=2.0):
+    '''
+        generator that polls every device using a pool of workers and yields
+        (device, config, error, timings, marker) tuples back on the calling thread
+
+        at most poller.window devices (two per worker plus a reachability batch)
+        are submitted at a time so a large fleet is never read into memory up front
+    '''
+    poller = Poller(workers, pool, probe, full_every, reach_timeout)
+    devices = iter(devices)
+    exhausted = False
+
+    try:
+        while not exhausted or poller.pending():
+            while not exhausted and poller.pending() < poller.window:
+                try:
+                    poller.submit(next(devices))
+                except StopIteration:
+                    exhausted = True
+
+            if poller.pending():
+                result = poller.result()
+                if result is not None:
+                    yield result
+    finally:
+        poller.close()
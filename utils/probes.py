@@ -0,0 +1,63 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    probes.py -> cheap "has anything changed?" checks before a full config fetch
+
+    Most polls find no change, yet the full running-config can be hundreds of
+    KB.  Device types with a small change marker (last change time, commit id,
+    config checksum) are probed for it first, and the full config is only
+    fetched when the marker differs from the one seen at the last full fetch.
+    Markers can miss some changes (e.g. regenerated certificates do not touch
+    the IOS last change time), so every device still gets a full fetch at
+    least every full_every seconds.
+
+    Device types without a probe are always fetched in full, and so are
+    devices whose probe output carries no marker (e.g. the command was rejected).
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import re
+
+#device_type -> (command, pattern whose first group is the marker)
+RAW_PROBES = {
+    'cisco_ios': ('show running-config | include Last configuration change', r'Last configuration change at (.*)'),
+    'cisco_xe': ('show running-config | include Last configuration change', r'Last configuration change at (.*)'),
+    'cisco_nxos': ('show running-config | include "Running configuration last done"', r'last done at:\s*(.*)'),
+    'cisco_xr': ('show configuration commit list 1', r'^\s*1\s+(\d+.*)$'),
+    'cisco_asa': ('show checksum', r'Cryptochecksum:\s*(.*)'),
+    'juniper': ('show system commit | match "^0 "', r'^0\s+(.*)$'),
+    'juniper_junos': ('show system commit | match "^0 "', r'^0\s+(.*)$'),
+}
+
+PROBES = dict((device_type, (command, re.compile(pattern, re.M)))
+    for device_type, (command, pattern) in RAW_PROBES.items())
+
+def probe_for(device, now, full_every=86400):
+    '''
+        returns the (command, pattern, marker) probe to run with the poll of a
+        device, None when its device type has no probe
+
+        marker is the one seen at the last full fetch, or None when the full
+        config has to be fetched anyway (no marker yet or full_every has passed)
+    '''
+    probe = PROBES.get(device.device_type)
+    if probe is None:
+        return None
+    marker = device.probe_marker
+    if device.full_fetched is None or now - device.full_fetched >= datetime.timedelta(seconds=full_every):
+        marker = None
+    return probe[0], probe[1], marker
+
+def extract_marker(pattern, output):
+    '''
+        returns the change marker in the output of a probe command, None when
+        the output does not contain one
+    '''
+    #a rejected command ("% Invalid input detected") prints the same text every
+    #time, taking it for a marker would hide every change until the next full fetch
+    match = pattern.search(output)
+    if match is None:
+        return None
+    return match.group(1).strip()[:255] or None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    profiles.py -> how the config of each device type is fetched
+
+    A profile names the command that prints the config, an optional paging
+    step, the prompt that ends its output, a delay factor and a read timeout.
+    netmiko's defaults (delay factor 1, find the prompt again before every
+    command, give up after 100 seconds) make fast devices wait on sleeps they
+    do not need and slow ones time out.  The profile is only the starting
+    point: once a device has been fetched its own smoothed fetch time
+    (device.fetch_time) sets the delay factor and timeout instead.
+
+    Profile fields
+        command      - prints the configuration
+        pager        - paging step run once per new session, None where the
+                       netmiko driver already disables paging correctly
+        prompt       - pattern matching the end of the output, {prompt} is the
+                       escaped base prompt; None lets netmiko find the prompt
+        delay_factor - netmiko delay factor (reads are polled every 0.2 x this)
+        timeout      - seconds to wait for the prompt
+
+    Copyright 2017 Ron Wellman
+'''
+
+import re
+
+#device_type -> (command, pager, prompt, delay_factor, timeout)
+PROFILES = {
+    'a10': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'alcatel_sros': ('admin display-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'arista_eos': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'aruba_os': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'avaya_ers': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'avaya_vsp': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'brocade_fastiron': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'brocade_netiron': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'brocade_nos': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'brocade_vdx': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'brocade_vyos': ('show configuration commands', None, r'{prompt}[\$#]\s*$', 1.0, 100),
+    'checkpoint_gaia': ('show configuration', None, None, 2.0, 200),
+    'ciena_saos': ('configuration show', None, None, 2.0, 200),
+    'cisco_asa': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'cisco_ios': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'cisco_nxos': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'cisco_s300': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'cisco_tp': ('xConfiguration', None, None, 1.0, 100),
+    'cisco_wlc': ('show run-config commands', None, r'{prompt}[>#]\s*$', 2.0, 300),
+    'cisco_xe': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'cisco_xr': ('show running-config', None, r'{prompt}[>#]\s*$', 2.0, 300),
+    'dell_force10': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'dell_powerconnect': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'eltex': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'enterasys': ('show config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'extreme': ('show configuration', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'f5_ltm': ('show running-config', None, None, 2.0, 300),
+    'fortinet': ('show', None, r'{prompt}[>#]\s*$', 2.0, 300),
+    'generic_termserver': ('show running-config', None, None, 1.0, 100),
+    'hp_comware': ('display current-configuration', None, r'{prompt}[>\]]\s*$', 1.0, 100),
+    'hp_procurve': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'huawei': ('display current-configuration', None, r'{prompt}[>\]]\s*$', 1.0, 100),
+    'juniper': ('show configuration', None, r'{prompt}[>#%]\s*$', 1.0, 100),
+    'juniper_junos': ('show configuration', None, r'{prompt}[>#%]\s*$', 1.0, 100),
+    'linux': ('show running-config', None, r'{prompt}[\$#]\s*$', 1.0, 100),
+    #netmiko only asks mellanox for 999 line pages, longer configs would stall on --More--
+    'mellanox_ssh': ('show running-config', 'no cli session paging enable', r'{prompt}[>#]\s*$', 1.0, 100),
+    'ovs_linux': ('ovs-vsctl show', None, r'{prompt}[\$#]\s*$', 1.0, 100),
+    'paloalto_panos': ('show config running', None, r'{prompt}[>#]\s*$', 2.0, 300),
+    'pluribus': ('running-config-show', None, None, 1.0, 100),
+    'quanta_mesh': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'ubiquiti_edge': ('show running-config', None, r'{prompt}[>#]\s*$', 1.0, 100),
+    'vyatta_vyos': ('show configuration commands', None, r'{prompt}[\$#]\s*$', 1.0, 100),
+    'vyos': ('show configuration commands', None, r'{prompt}[\$#]\s*$', 1.0, 100),
+}
+
+#used for device types without a profile of their own (what nbmon always did)
+DEFAULT_PROFILE = ('show running-config', None, None, 1.0, 100)
+
+#bounds of the delay factor learned from a device's fetch times
+MIN_DELAY = 0.1
+MAX_DELAY = 4.0
+#never wait less than this for the prompt, however fast the device has been
+MIN_TIMEOUT = 30
+#weight of the newest fetch time in device.fetch_time
+SMOOTHING = 0.3
+
+def profile_for(device_type):
+    '''
+        returns the (command, pager, prompt, delay_factor, timeout) profile of a device type
+    '''
+    return PROFILES.get(device_type, DEFAULT_PROFILE)
+
+def fetch_plan(device_type, fetch_time=None):
+    '''
+        returns the settings a worker fetches a device with as a plain dictionary
+
+        without a learned fetch_time these are the profile's own, otherwise reads
+        are polled about 50 times over the expected fetch and the prompt is
+        waited for up to four times as long as the device usually takes
+    '''
+    command, pager, prompt, delay_factor, timeout = profile_for(device_type)
+    if fetch_time is not None:
+        delay_factor = min(MAX_DELAY, max(MIN_DELAY, fetch_time / 10.0))
+        timeout = max(MIN_TIMEOUT, 4 * fetch_time)
+    return {'command': command, 'pager': pager, 'prompt': prompt,
+            'delay_factor': delay_factor, 'max_loops': int(timeout / (0.2 * delay_factor)) + 1}
+
+def learn_fetch_time(previous, seconds):
+    '''
+        returns the smoothed fetch time after a full fetch that took seconds
+    '''
+    if previous is None:
+        return seconds
+    return previous + SMOOTHING * (seconds - previous)
+
+def send(session, command, plan):
+    '''
+        runs a command on a netmiko session with the timing of a fetch plan and
+        returns its output
+    '''
+    #netmiko never goes below the session's global delay factor (1 by default)
+    session.global_delay_factor = plan['delay_factor']
+    if plan['pager'] is not None and getattr(session, 'nbmon_pager', None) != plan['pager']:
+        session.disable_paging(command=plan['pager'])
+        session.nbmon_pager = plan['pager']
+
+    expect = None
+    if plan['prompt'] is not None and session.base_prompt:
+        expect = plan['prompt'].replace('{prompt}', re.escape(session.base_prompt))
+    return session.send_command(command, expect_string=expect, delay_factor=plan['delay_factor'],
+        max_loops=plan['max_loops'])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    reachability.py -> bulk tcp pre-probe of the ssh port
+
+    A device that is down costs a full netmiko connect timeout before the poll
+    fails, one worker at a time.  Here a whole batch of devices gets a
+    non-blocking tcp connect to its ssh port at once, all sharing one short
+    deadline, so a few hundred dead devices cost seconds instead of minutes
+    and never occupy an ssh worker.  Connections that succeed are reset right
+    away (SO_LINGER 0) without any ssh traffic.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import errno
+import select
+import socket
+import struct
+import time
+
+class Unreachable(Exception):
+    '''
+        the ssh port of a device did not accept a tcp connection
+    '''
+
+def _close(sock):
+    try:
+        #reset instead of a graceful close, leaves no TIME_WAIT behind
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        sock.close()
+    except socket.error:
+        pass
+
+def check_ports(targets, timeout=2.0):
+    '''
+        connects to every (key, ip, port) target at once and returns a dictionary
+        of key -> Unreachable for the targets that did not accept within timeout
+        seconds; keys of reachable targets are left out
+    '''
+    failed = {}
+    #fileno -> (key, address, socket) of connects in progress
+    connecting = {}
+    for key, ip, port in targets:
+        address = '{}:{}'.format(ip, port)
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            code = sock.connect_ex((ip, port))
+        except socket.error as e:
+            code = e.errno
+        if code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connecting[sock.fileno()] = (key, address, sock)
+            continue
+        if code:
+            failed[key] = Unreachable('{}: {}'.format(address, errno.errorcode.get(code, code)))
+        if sock is not None:
+            _close(sock)
+
+    deadline = time.time() + timeout
+    #poll() has no FD_SETSIZE limit, select() is the fallback where it is missing
+    poller = select.poll() if hasattr(select, 'poll') else None
+    if poller is not None:
+        for fileno in connecting:
+            poller.register(fileno, select.POLLOUT)
+
+    while connecting:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        if poller is not None:
+            ready = [fileno for fileno, events in poller.poll(remaining * 1000)]
+        else:
+            ready = select.select([], list(connecting), [], remaining)[1]
+        for fileno in ready:
+            key, address, sock = connecting.pop(fileno)
+            if poller is not None:
+                poller.unregister(fileno)
+            code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code:
+                failed[key] = Unreachable('{}: {}'.format(address, errno.errorcode.get(code, code)))
+            _close(sock)
+
+    for key, address, sock in connecting.values():
+        failed[key] = Unreachable('{}: no answer within {}s'.format(address, timeout))
+        _close(sock)
+    return failed
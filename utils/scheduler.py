@@ -0,0 +1,227 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    scheduler.py -> resident poll scheduler
+
+    Devices are kept in a priority queue keyed on their next due time.  Each
+    device is polled every poll_interval seconds (or the daemon default),
+    recently changed devices are polled more often, and every due time is
+    jittered so devices loaded together do not stay in lockstep.  When more
+    devices are due than there are free workers, higher priority devices go
+    first.
+
+    With leases, due devices are claimed from the lease table instead of the
+    in-memory queue so several nbmon processes can share one database; a
+    crashed worker's leases expire after the lease ttl and its devices are
+    picked up by the others.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import datetime
+import heapq
+import random
+import time
+import db.sqlite_query as db
+from utils.util import record_poll
+
+class Scheduler(object):
+    '''
+        priority queue of device ids ordered by next due time
+    '''
+
+    def __init__(self, interval=3600, jitter=0.1, recent=86400, recent_factor=0.25, minimum=60):
+        self.interval = interval
+        self.jitter = jitter
+        self.recent = datetime.timedelta(seconds=recent)
+        self.recent_factor = recent_factor
+        self.minimum = minimum
+        #(due, device_id) waiting for their due time
+        self.waiting = []
+        #(-priority, due, device_id) already due, waiting for a free worker
+        self.ready = []
+        #device_id -> (due, priority), used to skip superseded heap entries
+        self.entries = {}
+
+    def device_interval(self, device, now):
+        '''
+            returns the poll interval for a device in seconds
+        '''
+        interval = device.poll_interval or self.interval
+        if device.last_change and now - device.last_change < self.recent:
+            interval *= self.recent_factor
+        return max(self.minimum, interval)
+
+    def next_due(self, device, now):
+        '''
+            returns the jittered time the device should next be polled
+        '''
+        interval = self.device_interval(device, now)
+        spread = interval * self.jitter
+        return now + datetime.timedelta(seconds=interval + random.uniform(-spread, spread))
+
+    def push(self, device, due):
+        '''
+            (re)schedules a device for the given due time
+        '''
+        self.entries[device.device_id] = (due, device.priority or 0)
+        heapq.heappush(self.waiting, (due, device.device_id))
+
+    def forget(self, device_id):
+        '''
+            drops a device from the schedule
+        '''
+        self.entries.pop(device_id, None)
+
+    def sync(self, devices, now):
+        '''
+            adds newly activated devices and forgets devices that are no longer active
+
+            devices without a stored next_poll are spread over their first interval
+            so a freshly loaded inventory does not all come due at once
+        '''
+        active = set()
+        for device in devices:
+            active.add(device.device_id)
+            if device.device_id in self.entries:
+                continue
+            due = device.next_poll
+            if due is None:
+                offset = random.uniform(0, self.device_interval(device, now))
+                due = now + datetime.timedelta(seconds=offset)
+            self.push(device, due)
+
+        for device_id in set(self.entries) - active:
+            self.forget(device_id)
+
+    def pop_due(self, now, limit):
+        '''
+            returns up to limit device ids that are due, highest priority first
+        '''
+        while self.waiting and self.waiting[0][0] <= now:
+            due, device_id = heapq.heappop(self.waiting)
+            entry = self.entries.get(device_id)
+            if entry and entry[0] == due:
+                heapq.heappush(self.ready, (-entry[1], due, device_id))
+
+        due_ids = []
+        while self.ready and len(due_ids) < limit:
+            priority, due, device_id = heapq.heappop(self.ready)
+            if self.entries.get(device_id, (None,))[0] == due:
+                due_ids.append(device_id)
+        return due_ids
+
+    def wait(self, now):
+        '''
+            returns the number of seconds until the next device is due
+        '''
+        if self.ready:
+            return 0
+        if not self.waiting:
+            return self.interval
+        return max(0, (self.waiting[0][0] - now).total_seconds())
+
+def run(scheduler, poller, logfile, pool=None, compactor=None, metrics=None, sync_every=300, tick=1.0):
+    '''
+        polls devices as they come due until interrupted
+
+        all database work happens here on the calling thread, the poller's
+        workers only run the ssh sessions; an open write batch is committed
+        once its time window passes even while no polls are finishing
+
+        with a compactor, retention runs a small step at a time whenever no
+        poll is in flight; metrics, when given, is called with no arguments
+        every sync_every seconds to export poll timings
+    '''
+    last_sync = None
+
+    while True:
+        now = datetime.datetime.utcnow()
+        db.flush_batch()
+
+        #pick up devices added, removed, or toggled since the last pass
+        if last_sync is None or (now - last_sync).total_seconds() >= sync_every:
+            scheduler.sync(db.next_active_device(), now)
+            if pool is not None:
+                pool.evict_idle()
+            if metrics is not None and last_sync is not None:
+                metrics()
+            last_sync = now
+
+        room = poller.window - poller.pending()
+        for device_id in scheduler.pop_due(now, room):
+            device = db.get_device(device_id)
+            if device is not None and device.actively_poll:
+                poller.submit(device)
+            else:
+                scheduler.forget(device_id)
+
+        if not poller.pending():
+            #nothing in flight, compact or sleep until the next device comes due
+            if compactor is None or compactor.step():
+                time.sleep(min(tick, scheduler.wait(now)))
+            continue
+
+        result = poller.result(timeout=tick)
+        if result is None:
+            continue
+
+        device, config, error, timings, marker = result
+        record_poll(device, config, error, logfile, timings, marker)
+
+        now = datetime.datetime.utcnow()
+        due = scheduler.next_due(device, now)
+        db.reschedule(device, due)
+        db.poll_done()
+        scheduler.push(device, due)
+
+def run_leased(scheduler, poller, logfile, owner, ttl=900, forever=False, metrics=None, sync_every=300, tick=1.0):
+    '''
+        polls devices claimed through the lease table so several processes, on
+        one host or several, can share the device table
+
+        each finished device is given its next due time and released in the same
+        transaction, so no other worker polls it again before then; without
+        forever this returns once no device is left to claim and nothing is in flight
+
+        metrics, when given, is called with no arguments every sync_every seconds
+    '''
+    claimed = True
+    last_sync = datetime.datetime.utcnow()
+
+    while True:
+        db.flush_batch()
+
+        now = datetime.datetime.utcnow()
+        if metrics is not None and (now - last_sync).total_seconds() >= sync_every:
+            metrics()
+            last_sync = now
+
+        #claim in bulk once half the queue is free to keep claim transactions rare; not
+        #poller.window, claimed devices must all be polled well within their lease ttl
+        room = poller.workers * 2 - poller.pending()
+        if room >= poller.workers:
+            devices = db.claim_devices(owner, room, ttl)
+            for device in devices:
+                poller.submit(device)
+            claimed = bool(devices)
+
+        if not poller.pending():
+            if not claimed and not forever:
+                return
+            time.sleep(tick)
+            continue
+
+        result = poller.result(timeout=0)
+        if result is None:
+            #nothing ready, commit what has been recorded so the write lock is not held while waiting
+            db.flush_batch(force=True)
+            result = poller.result(timeout=tick)
+            if result is None:
+                continue
+
+        device, config, error, timings, marker = result
+        record_poll(device, config, error, logfile, timings, marker)
+        db.reschedule(device, scheduler.next_due(device, datetime.datetime.utcnow()))
+        db.release_device(device, owner)
+        db.poll_done()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+    sshpool.py -> persistent ssh sessions shared across poll cycles
+
+    Sessions are keyed by device and handed to one worker at a time.  Idle
+    sessions are kept alive with ssh keepalives, evicted after idle_timeout
+    seconds, and the least recently used idle session is closed whenever
+    max_open would otherwise be exceeded.
+
+    Copyright 2017 Ron Wellman
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+class SessionPool(object):
+    '''
+        thread safe pool of netmiko sessions keyed by device
+    '''
+
+    def __init__(self, max_open=100, idle_timeout=300, keepalive=30):
+        self.max_open = max(1, max_open)
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.cond = threading.Condition()
+        #key -> (session, last used), oldest first
+        self.idle = OrderedDict()
+        self.open = 0
+
+    @staticmethod
+    def key(params):
+        '''
+            returns the pool key for a set of connection parameters
+        '''
+        return (params['device_type'], params['ip'], params['port'], params['username'])
+
+    @staticmethod
+    def alive(session):
+        '''
+            returns True if the ssh transport and channel of a session are still usable
+        '''
+        try:
+            transport = session.remote_conn_pre.get_transport()
+            return transport is not None and transport.is_active() and not session.remote_conn.closed
+        except Exception:
+            return False
+
+    def holds(self, params):
+        '''
+            returns True if an idle session to the device is waiting in the pool
+        '''
+        with self.cond:
+            return self.key(params) in self.idle
+
+    def _discard(self, sessions):
+        '''
+            disconnects sessions that have already been removed from the pool
+        '''
+        for session in sessions:
+            try:
+                session.disconnect()
+            except Exception:
+                pass
+
+    def _expired(self, now):
+        '''
+            removes idle sessions past idle_timeout, caller must hold the lock
+        '''
+        stale = []
+        for key in list(self.idle):
+            session, used = self.idle[key]
+            if now - used < self.idle_timeout:
+                #the dictionary is ordered by last use so nothing later is stale
+                break
+            del self.idle[key]
+            stale.append(session)
+        self.open -= len(stale)
+        return stale
+
+    def evict_idle(self):
+        '''
+            closes every idle session that has not been used within idle_timeout
+        '''
+        with self.cond:
+            stale = self._expired(time.time())
+            if stale:
+                self.cond.notify_all()
+        self._discard(stale)
+
+    def acquire(self, params, fresh=False):
+        '''
+            returns a (session, reused) tuple for the device, opening a new session
+            only when there is no usable idle one
+        '''
+        key = self.key(params)
+        stale = []
+        reused = None
+
+        with self.cond:
+            while True:
+                stale.extend(self._expired(time.time()))
+
+                if key in self.idle:
+                    session, used = self.idle.pop(key)
+                    if not fresh and self.alive(session):
+                        reused = session
+                        break
+                    self.open -= 1
+                    stale.append(session)
+
+                if self.open < self.max_open:
+                    self.open += 1
+                    break
+                elif self.idle:
+                    #make room by closing the least recently used idle session
+                    session, used = self.idle.popitem(last=False)[1]
+                    self.open -= 1
+                    stale.append(session)
+                else:
+                    self.cond.wait(1)
+
+        self._discard(stale)
+        if reused is not None:
+            return reused, True
+
+        try:
+            from netmiko import ConnectHandler
+            session = ConnectHandler(**params)
+            if self.keepalive:
+                session.remote_conn_pre.get_transport().set_keepalive(self.keepalive)
+        except Exception:
+            with self.cond:
+                self.open -= 1
+                self.cond.notify()
+            raise
+
+        return session, False
+
+    def release(self, params, session, broken=False):
+        '''
+            returns a session to the pool, broken sessions are closed instead
+        '''
+        key = self.key(params)
+        stale = []
+
+        with self.cond:
+            if broken or key in self.idle:
+                self.open -= 1
+                stale.append(session)
+            else:
+                self.idle[key] = (session, time.time())
+            self.cond.notify()
+
+        self._discard(stale)
+
+    def run(self, params, func, timings=None):
+        '''
+            calls func(session) with a pooled session for the device
+
+            a failure on a reused session is retried once on a fresh connection
+            so channels that died while idle reconnect transparently
+
+            with a timings dictionary the seconds spent getting a session and
+            running func are added to its connect and fetch entries
+        '''
+        timings = timings if timings is not None else {}
+        fresh = False
+        while True:
+            started = time.time()
+            try:
+                session, reused = self.acquire(params, fresh)
+            finally:
+                timings['connect'] = timings.get('connect', 0) + time.time() - started
+
+            started = time.time()
+            try:
+                result = func(session)
+            except Exception:
+                self.release(params, session, broken=True)
+                if not reused:
+                    raise
+                fresh = True
+                continue
+            finally:
+                timings['fetch'] = timings.get('fetch', 0) + time.time() - started
+            self.release(params, session)
+            return result
+
+    def close(self):
+        '''
+            disconnects every idle session
+        '''
+        with self.cond:
+            sessions = [session for session, used in self.idle.values()]
+            self.open -= len(sessions)
+            self.idle.clear()
+            self.cond.notify_all()
+        self._discard(sessions)
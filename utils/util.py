@@ -5,71 +5,230 @@
 
     Copyright 2017 Ron Wellman
 '''
-from netmiko import ConnectHandler
-from netmiko.ssh_exception import NetMikoTimeoutException
 from hashlib import sha512
-from difflib import unified_diff as udiff
 import datetime
+import itertools
+import time
+import json
+import csv
 import click
 import ipaddress
 import db.sqlite_query as db
+from utils.normalize import normalize_config
+from utils.probes import extract_marker
+from utils.profiles import fetch_plan, learn_fetch_time, send
+from utils.reachability import Unreachable
+import utils.alerts as alerts
 
-def get_config(device, logfile):
+def connection_params(device):
     '''
-        Connects to a device and returns its config
+        returns the netmiko connection parameters for a device as a plain dictionary
+    '''
+    #device contains extra fields that cause issues with netmiko
+    fields = ('device_type','ip','username', 'password','port','secret')
+
+    #copying required fields into a new dictionary, the orm object is left untouched
+    return dict((f, getattr(device, f)) for f in fields)
+
+def fetch_config(params, pool=None, timings=None, plan=None):
+    '''
+        connects to a device described by connection_params() and returns its config
+
+        when a SessionPool is given the ssh session is borrowed from it and kept
+        open for the next poll, otherwise a new session is opened and closed
+
+        with a timings dictionary the seconds spent connecting and fetching are
+        stored in its connect and fetch entries
+
+        plan is the utils.profiles.fetch_plan() of the device, by default the
+        plain profile of its device type
+
+        touches no database state so it is safe to call from a worker thread
+    '''
+    return poll_device(params, None, pool, timings, plan)[0]
+
+def poll_device(params, probe=None, pool=None, timings=None, plan=None):
+    '''
+        like fetch_config() but runs the (command, pattern, marker) probe from
+        utils.probes.probe_for() first, returns a (config, marker) tuple
+
+        config is None when the probe found the marker of the last full fetch,
+        i.e. nothing changed and the full config was never transferred
     '''
-    if device.device_type == 'cisco_ios':
-        #device contains extra fields that cause issues with netmiko
-        fields = ('device_type','ip','username', 'password','port','secret')
+    plan = plan or fetch_plan(params['device_type'])
 
-    new_device = {}
-    old_device = device.__dict__
+    def run(net_connect):
+        marker = None
+        if probe is not None:
+            command, pattern, last = probe
+            marker = extract_marker(pattern, send(net_connect, command, plan))
+            if last is not None and marker == last:
+                return None, marker
+        return send(net_connect, plan['command'], plan), marker
 
-    #pulling required fields out and placing in a new dictionary
-    for f in fields:
-        new_device[f] = old_device.pop(f)
+    if pool is not None:
+        return pool.run(params, run, timings)
 
+    #netmiko pulls in paramiko and cryptography, only paid for when a device is polled
+    from netmiko import ConnectHandler
+
+    timings = timings if timings is not None else {}
+    started = time.time()
+    try:
+        net_connect = ConnectHandler(**params)
+    finally:
+        timings['connect'] = time.time() - started
     try:
-        net_connect = ConnectHandler(**new_device)
-        return net_connect.send_command('show running-config')
+        started = time.time()
+        return run(net_connect)
+    finally:
+        timings['fetch'] = time.time() - started
+        net_connect.disconnect()
+
+def get_config(device, logfile):
+    '''
+        Connects to a device and returns its config
+    '''
+    from netmiko.ssh_exception import NetMikoTimeoutException
+    try:
+        return fetch_config(connection_params(device), plan=fetch_plan(device.device_type, device.fetch_time))
     except NetMikoTimeoutException as e:
         generate_log(logfile, e, 'WARNING')
         db.missed_poll(device)
         return None
 
+def alert(logfile, event):
+    '''
+        queues an alert for the background sinks, or logs it right away when
+        no alert queue is running
+    '''
+    if not alerts.publish(event):
+        alerts.LogSink(logfile).send([event])
+
+def record_poll(device, config, error, logfile, timings=None, marker=None):
+    '''
+        stores the outcome of a single poll, returns True when the config changed
+
+        timings holds the connect and fetch seconds measured by the worker, the
+        hash and persist phases are timed here and the poll is added to poll_history
+
+        a config of None means the change probe showed nothing changed, otherwise
+        the probe marker seen with the config is kept for the next poll and the
+        fetch time is learned for utils.profiles.fetch_plan()
+    '''
+    timings = dict(timings or {})
+    timestamp = datetime.datetime.utcnow()
+
+    if error is not None:
+        alert(logfile, alerts.make_event('missed', device, unicode(error), timestamp))
+        started = time.time()
+        db.missed_poll(device)
+        if device.fetch_time is not None and not isinstance(error, Unreachable):
+            #the device may just have become slower, start over from its profile
+            db.update_fetch_time(device, None)
+        timings['persist'] = time.time() - started
+        db.record_history(device, timestamp, 'failed', timings, error=type(error).__name__)
+        return False
+
+    if config is None:
+        started = time.time()
+        db.update_timestamp(device, timestamp)
+        timings['persist'] = time.time() - started
+        db.record_history(device, timestamp, 'probed', timings)
+        return False
+
+    size = len(config)
+    started = time.time()
+    #volatile lines are removed so they neither trigger nor store a change
+    config = normalize_config(device.device_type, config)
+    hconfig = generate_hash(config)
+    timings['hash'] = time.time() - started
+
+    #Compare newly hashed config to the last one entered into the db
+    started = time.time()
+    db.update_probe(device, marker, timestamp)
+    if 'fetch' in timings:
+        db.update_fetch_time(device, learn_fetch_time(device.fetch_time, timings['fetch']))
+    changed = not db.compare_config(device,hconfig)
+    if changed and device.latest_config_id is not None:
+        #configs stored before normalization still hash with their volatile lines,
+        #the newest one is normalized once and compared by body instead
+        latest = normalize_config(device.device_type, db.config_body(device.latest_config_id))
+        if generate_hash(latest) == hconfig:
+            db.update_latest_hash(device, hconfig)
+            changed = False
+    if changed:
+        db.insert_config(device, hconfig, config, timestamp)
+        timings['persist'] = time.time() - started
+        alert(logfile, alerts.make_event('change', device, '{} configuration change'.format(device.ip), timestamp))
+        db.record_history(device, timestamp, 'changed', timings, size)
+        return True
+    else:
+        db.update_timestamp(device, timestamp)
+        timings['persist'] = time.time() - started
+        db.record_history(device, timestamp, 'unchanged', timings, size)
+        return False
+
 def generate_hash(config):
     '''
         return the sha512 hexdigest of the input text
     '''
     return sha512(config).hexdigest()
 
-def display_status():
+def page(lines):
     '''
-        build a display showing devices that are active and have either missed a poll or had a configuration change
+        sends lines to the pager, streaming them when click supports generators
     '''
-    #header
-    output = '{:^6}  {:^15}  {:^25}  {:^23}  {:^6}  {:^7}'.format('DEVICE','IP','DESCRIPTION','LAST_SEEN','MISSED', 'CHANGES')
+    if int(click.__version__.split('.')[0]) >= 7:
+        click.echo_via_pager(line + '\n' for line in lines)
+    else:
+        click.echo_via_pager('\n'.join(lines))
 
-    for device in db.next_missed_device():
+STATUS_FIELDS = ('device_id', 'ip', 'description', 'last_seen', 'last_change', 'missed_polls', 'config_changes')
 
-        if len(device.description) > 25:
-            description = device.description[:26]
-        else:
-            description = device.description
+def status_line(row):
+    '''
+        formats a row from db.status_rows() for the status table, None gives the header
+    '''
+    if row is None:
+        return '{:^6}  {:^15}  {:^25}  {:^23}  {:^6}  {:^7}'.format('DEVICE','IP','DESCRIPTION','LAST_SEEN','MISSED', 'CHANGES')
 
-        if device.last_seen:
-            #accumulate output
-            output = '\n'.join([output,'{:>6}  {:<15}  {:<25}  {:%Y-%m-%d %H:%M:%S} UTC  {:>6}  {:>7}'.format(\
-                device.device_id, device.ip, description, device.last_seen,
-                device.missed_polls, device.config_changes)])
-        else:
-            #accumulate output
-            output = '\n'.join([output,'{:>6}  {:<15}  {:<25}  {:^23}  {:>6}  {:>7}'.format(\
-                device.device_id, device.ip, description, 'NEVER',
-                device.missed_polls, device.config_changes)])
+    description = (row.description or '')[:25]
+
+    if row.last_seen:
+        return '{:>6}  {:<15}  {:<25}  {:%Y-%m-%d %H:%M:%S} UTC  {:>6}  {:>7}'.format(\
+            row.device_id, row.ip, description, row.last_seen,
+            row.missed_polls, row.config_changes)
+    else:
+        return '{:>6}  {:<15}  {:<25}  {:^23}  {:>6}  {:>7}'.format(\
+            row.device_id, row.ip, description, 'NEVER',
+            row.missed_polls, row.config_changes)
+
+def display_status(only_missed=False, changed_since=None, limit=None, output='table'):
+    '''
+        build a display showing devices that are active and have either missed a poll or had a configuration change
 
-    #generates pages of output rather than overwhelming the screen
-    click.echo_via_pager(output)
+        table output goes to the pager, json and csv are streamed to stdout a row at a time
+    '''
+    rows = db.status_rows(only_missed, changed_since, limit)
+
+    if output == 'json':
+        click.echo('[', nl=False)
+        for count, row in enumerate(rows):
+            record = dict(zip(STATUS_FIELDS, row))
+            for field in ('last_seen', 'last_change'):
+                if record[field]:
+                    record[field] = record[field].isoformat()
+            click.echo('{}\n{}'.format(',' if count else '', json.dumps(record)), nl=False)
+        click.echo('\n]')
+    elif output == 'csv':
+        out = click.get_text_stream('stdout')
+        writer = csv.writer(out)
+        writer.writerow(STATUS_FIELDS)
+        for row in rows:
+            writer.writerow([unicode(value).encode('utf-8') if value is not None else '' for value in row])
+    else:
+        page(status_line(row) for row in itertools.chain([None], rows))
 
 def clear_counters():
     '''
@@ -84,7 +243,8 @@ def edit_device(logfile, verbose):
     '''
     edit = {'2':'device_type','3':'ip','4':'port','5':'description',\
             '6':'username','7':'password','8':'secret','9':'actively_poll',\
-            '10':'last_seen','11':'missed_polls','12':'config_changes'}
+            '10':'last_seen','11':'missed_polls','12':'config_changes',\
+            '14':'poll_interval','15':'priority'}
     for device in db.next_device():
         #outer loop to keep same device loaded in the menu
         while True:
@@ -182,6 +342,22 @@ def edit_device(logfile, verbose):
                         msg = 'Device {} config_changes cleared.'.format(device.device_id)
                         generate_log(logfile, msg, 'INFO')
                     db.update_device(device, edit[choice], 0)
+            elif choice =='14':
+                value = validate_poll_interval(device)
+                if value != None:
+                    #cleared, the daemon --interval applies again
+                    value = None if value == 'C' else value
+                    if verbose:
+                        msg = 'Device {} poll_interval modified from "{}" to "{}".'.format(device.device_id, device.poll_interval, value)
+                        generate_log(logfile, msg, 'INFO')
+                    db.update_device(device, edit[choice], value)
+            elif choice =='15':
+                value = validate_priority(device)
+                if value != None:
+                    if verbose:
+                        msg = 'Device {} priority modified from "{}" to "{}".'.format(device.device_id, device.priority, value)
+                        generate_log(logfile, msg, 'INFO')
+                    db.update_device(device, edit[choice], value)
             else:
                 print('\nInvalid Entry\n')
                 click.pause()
@@ -191,7 +367,7 @@ def print_edit_menu(device):
     '''
         builds a menu for editing a device
     '''
-    total = len(device.configs)
+    total = db.config_count(device)
 
     click.clear()
     print('[DEVICE]')
@@ -209,6 +385,8 @@ def print_edit_menu(device):
     click.echo(click.style('11 - Missed Polls   : {}'.format(device.missed_polls), fg='green'))
     click.echo(click.style('12 - Config Changes : {}'.format(device.config_changes), fg='green'))
     click.echo(click.style('13 - Num of Configs : {}'.format(total), fg='green'))
+    click.echo(click.style('14 - Poll Interval  : {}'.format(device.poll_interval or 'daemon default'), fg='green'))
+    click.echo(click.style('15 - Priority       : {}'.format(device.priority or 0), fg='green'))
     print('==============================================')
     click.echo('Entries in ' + click.style('Red',fg='red') + ' cannot be changed')
     print('')
@@ -487,6 +665,61 @@ def validate_config_changes(device):
             print('\nInvalid Entry\n')
             click.pause()
 
+def validate_poll_interval(device):
+    '''
+        validates changes to poll_interval
+    '''
+    while True:
+        click.clear()
+        print('[DEVICE > POLL INTERVAL]')
+        print('==============================================')
+        click.echo(click.style('14 - Poll Interval  : {}'.format(device.poll_interval or 'daemon default'), fg='green'))
+        print('==============================================')
+        print('<A> - Abort, <C> - Clear (use the daemon default)')
+        print('')
+
+        value = click.prompt('New value in seconds (60 or more)').upper()
+
+        if value == 'A':
+            return None
+        elif value == 'C':
+            return value
+        else:
+            try:
+                value = int(value)
+                if value >= 60:
+                    return value
+                else:
+                    print('\nInvalid Interval\n')
+                    click.pause()
+            except:
+                print('\nInvalid Entry\n')
+                click.pause()
+
+def validate_priority(device):
+    '''
+        validates changes to priority
+    '''
+    while True:
+        click.clear()
+        print('[DEVICE > PRIORITY]')
+        print('==============================================')
+        click.echo(click.style('15 - Priority       : {}'.format(device.priority or 0), fg='green'))
+        print('==============================================')
+        print('<A> - Abort')
+        print('')
+
+        value = click.prompt('New value (higher is polled first)')
+
+        if value.upper() == 'A':
+            return None
+        else:
+            try:
+                return int(value)
+            except:
+                print('\nInvalid Entry\n')
+                click.pause()
+
 def validate_config(device, logfile, verbose):
     '''
         builds a menu for displaying, deleting, and comparing configs for a device
@@ -494,20 +727,23 @@ def validate_config(device, logfile, verbose):
     counter = 0
 
     while True:
-        total = (len(device.configs))
+        #only the configs on screen are read, never the whole history
+        total = db.config_count(device)
+        counter = min(counter, max(0, total - 1))
+        config = db.nth_config(device, counter)
         click.clear()
         print('[DEVICE > CONFIGS]')
         print('==============================================')
         click.echo(click.style(' 1 - Device ID       : {}'.format(device.device_id), fg='red'))
         if total > 0:
             click.echo(click.style(' 2 - Config          : {} of {}'.format(counter + 1, total), fg='green'))
-            click.echo(click.style(' 3 - Timestamp       : {:%Y-%m-%d %H:%M:%S} UTC'.format(device.configs[counter].timestamp), fg='red'))
+            click.echo(click.style(' 3 - Timestamp       : {:%Y-%m-%d %H:%M:%S} UTC'.format(config.timestamp), fg='red'))
         else:
             click.echo(click.style(' 2 - Config          : {} of {}'.format(counter, total), fg='red'))
             click.echo(click.style(' 3 - Timestamp       :', fg='red'))
         print('==============================================')
         if total > 0:
-            print('<V> - View Config, <C> - Compare Latest Configs, <N> - Next, <P> - Previous, <D> - Delete Config, <Q> - Quit')
+            print('<V> - View Config, <C> - Compare With Previous, <H> - Compare Sections, <N> - Next, <P> - Previous, <D> - Delete Config, <Q> - Quit')
             print('')
         else:
             print('\nThere are no remaining configs.\n')
@@ -530,19 +766,16 @@ def validate_config(device, logfile, verbose):
             if verbose:
                 msg = 'Config {} deleted from device {}.'.format(counter,device.device_id)
                 generate_log(logfile, msg, 'INFO')
-            db.delete_config(device.configs[counter])
+            db.delete_config(config)
             if counter > 0:
                 counter -= 1
         elif choice == 'V' or choice == '2':
-            click.echo_via_pager(device.configs[counter].config)
-        elif choice == 'C':
-            if total >= 2:
-                difference = []
-                for line in udiff(device.configs[0].config.split('\n'), device.configs[1].config.split('\n'),\
-                        fromfile='{:%Y-%m-%d %H:%M:%S} UTC'.format(device.configs[0].timestamp),\
-                        tofile='{:%Y-%m-%d %H:%M:%S} UTC'.format(device.configs[1].timestamp)):
-                    difference.append(line)
-                click.echo_via_pager('\n'.join(difference))
+            click.echo_via_pager(config.config)
+        elif choice == 'C' or choice == 'H':
+            #configs are newest first so the previous config is the next one in the list
+            if counter + 1 < total:
+                mode = 'unified' if choice == 'C' else 'sections'
+                click.echo_via_pager(db.config_diff(db.nth_config(device, counter + 1), config, mode))
             else:
                 print('\nNot enough configs to compare.\n')
                 click.pause()
@@ -550,6 +783,69 @@ def validate_config(device, logfile, verbose):
             print('\nInvalid Entry\n')
             click.pause()
 
+def search_report(pattern, latest_only=False, since=None, until=None):
+    '''
+        pages every stored config line containing pattern, grouped by device and config
+    '''
+    def lines():
+        for config, matches in db.search_configs(pattern, latest_only, since, until):
+            device = config.device
+            yield '{} {} ({}) - version {} at {:%Y-%m-%d %H:%M:%S} UTC'.format(device.device_id if device else '-',
+                device.ip if device else '-', device.description if device else 'deleted device',
+                config.version, config.timestamp)
+            for line in matches:
+                yield '    {}'.format(line)
+
+    page(lines())
+
+def changes_report(since):
+    '''
+        pages every config change stored since the given time using the diffs
+        taken when the configs were inserted
+    '''
+    def lines():
+        for device, config in db.next_change(since):
+            yield '=' * 78
+            yield '{} {} ({}) - version {} at {:%Y-%m-%d %H:%M:%S} UTC'.format(device.device_id,
+                device.ip, device.description, config.version, config.timestamp)
+            yield '=' * 78
+            yield db.change_diff(config) or '(first config)'
+            yield ''
+
+    page(lines())
+
+def as_of_report(device, ts):
+    '''
+        pages the config a device was running at a point in time, returns False
+        when it had no config stored by then
+    '''
+    config = db.config_as_of(device, ts)
+    if config is None:
+        return False
+    click.echo_via_pager(config.config)
+    return True
+
+def history_report(device=None, since=None, until=None):
+    '''
+        pages the versions of a device's config stored within [since, until], or
+        without a device the number of versions every device stored in that range
+    '''
+    def lines():
+        if device is None:
+            yield '{:^6}  {:^15}  {:^25}  {:>7}  {:^23}  {:^23}'.format('DEVICE', 'IP', 'DESCRIPTION', 'CONFIGS',
+                'FIRST', 'LAST')
+            for device_id, ip, description, count, first, last in db.version_counts(since, until):
+                yield '{:>6}  {:<15}  {:<25}  {:>7}  {:%Y-%m-%d %H:%M:%S} UTC  {:%Y-%m-%d %H:%M:%S} UTC'.format(
+                    device_id, ip, (description or '')[:25], count, first, last)
+            return
+
+        yield '{} {} ({}) - {} configs'.format(device.device_id, device.ip, device.description,
+            db.config_count(device, since, until))
+        for config_id, version, timestamp, hconfig in db.config_versions(device, since, until):
+            yield '    version {:>5} at {:%Y-%m-%d %H:%M:%S} UTC  {}'.format(version or '-', timestamp, hconfig[:16])
+
+    page(lines())
+
 def generate_log(logfile, msg, severity):
     '''
         writes an entry to the log